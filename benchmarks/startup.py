@@ -0,0 +1,78 @@
+"""
+Measure envars startup per subcommand.
+
+    python benchmarks/startup.py [--runs 5]
+
+Each subcommand is run against a throwaway envars file with
+``python -X importtime`` and reports the best wall clock time, the
+cumulative import time and whether boto3/jinja2 were imported at all.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+COMMANDS = [
+    ('help', ''),
+    ('init', 'init --app bench --environments prod,staging --kms-key-arn abc'),
+    ('validate', 'validate'),
+    ('print', 'print -a master'),
+    ('print -e', 'print -a master -e prod'),
+]
+
+IMPORT_LINE = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def run(filename, cmd):
+    start = time.perf_counter()
+    ret = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'envars.envars', '-f', filename] + cmd.split(),
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if ret.returncode != 0:
+        raise (Exception(f'"{cmd}" failed: {ret.stderr[-500:]}'))
+
+    total = 0
+    modules = set()
+    for line in ret.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            modules.add(match.group(3))
+            if len(match.group(2)) == 1:
+                total += int(match.group(1))
+    return elapsed, total / 1e6, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='envars startup benchmark')
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=5,
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'envars.yml')
+        run(filename, COMMANDS[1][1])
+        run(filename, 'add BENCH=value')
+
+        print(f'{"command":<12} {"wall (s)":>10} {"imports (s)":>12}  boto3  jinja2')
+        for name, cmd in COMMANDS:
+            results = [run(filename, cmd) for _ in range(args.runs)]
+            wall = min(r[0] for r in results)
+            imports = min(r[1] for r in results)
+            modules = results[0][2]
+            print(
+                f'{name:<12} {wall:>10.3f} {imports:>12.3f}  '
+                f'{"yes" if "boto3" in modules else "no":<5}  {"yes" if "jinja2" in modules else "no"}'
+            )
+
+
+if __name__ == '__main__':
+    main()
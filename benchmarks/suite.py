@@ -0,0 +1,381 @@
+"""
+Benchmark envars offline against local KMS/SSM/STS stand-ins.
+
+    python benchmarks/suite.py [--vars 500] [--envs 4] [--accounts 2] [--latency 20]
+    python benchmarks/suite.py --save-baseline baseline.json
+    python benchmarks/suite.py --baseline baseline.json [--threshold 0.2]
+
+A synthetic envars.yml is generated with the requested number of
+variables, environments, accounts, secrets, templates and parameter store
+references. Each benchmark reports its best wall time over --repeat runs,
+the AWS calls it made and its peak traced memory. With --baseline the
+results are compared and the exit code is 1 if any benchmark got slower
+than the threshold or made more AWS calls. The run also fails if a fast
+path (e.g. loading a snapshot) isn't faster than the path it replaces.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from envars import envars as cli  # noqa: E402
+from envars.aws import get_client  # noqa: E402
+from envars.models import EnVars  # noqa: E402
+
+ACCOUNT_ID_BASE = 100000000000
+# (benchmark, benchmark it must beat), a fast path slower than what it replaces fails the run
+MUST_BEAT = [
+    ('load snapshot', 'load'),
+    ('load snapshot table', 'load table'),
+]
+
+
+class Response(object):
+    status_code = 200
+    headers = {}
+
+
+class StandIns(object):
+    """
+    Answers KMS, SSM and STS calls locally through botocore event hooks,
+    after sleeping latency seconds, and counts them.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def install(self):
+        for service in ['kms', 'ssm', 'sts']:
+            events = get_client(service).meta.events
+            events.register(f'before-parameter-build.{service}', self._capture)
+            events.register(f'before-call.{service}', self._respond)
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+
+    def _capture(self, params, context, **kwargs):
+        context['benchmark_params'] = dict(params)
+
+    def _respond(self, model, context, **kwargs):
+        with self._lock:
+            self.calls[f'{model.service_model.service_name}:{model.name}'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, f'_{model.service_model.service_name}_{model.name}')
+        return Response(), handler(**context['benchmark_params'])
+
+    # blobs are "context json \0 plaintext" so decrypt checks the context like KMS does
+    def _kms_Encrypt(self, KeyId, Plaintext, EncryptionContext=None):
+        return {'CiphertextBlob': self._seal(Plaintext, EncryptionContext), 'KeyId': KeyId}
+
+    def _kms_Decrypt(self, CiphertextBlob, EncryptionContext=None):
+        context, plaintext = CiphertextBlob.split(b'\0', 1)
+        if json.loads(context) != (EncryptionContext or {}):
+            raise (Exception('stand-in KMS: encryption context mismatch'))
+        return {'Plaintext': plaintext}
+
+    def _kms_GenerateDataKey(self, KeyId, KeySpec, EncryptionContext=None):
+        key = os.urandom(32)
+        return {'Plaintext': key, 'CiphertextBlob': self._seal(key, EncryptionContext), 'KeyId': KeyId}
+
+    def _ssm_GetParameter(self, Name, WithDecryption=False):
+        return {'Parameter': {'Name': Name, 'Value': f'value-of-{Name}'}}
+
+    def _ssm_GetParameters(self, Names, WithDecryption=False):
+        return {'Parameters': [{'Name': name, 'Value': f'value-of-{name}'} for name in Names], 'InvalidParameters': []}
+
+    def _ssm_GetParametersByPath(self, Path, **kwargs):
+        return {'Parameters': []}
+
+    def _sts_GetCallerIdentity(self):
+        return {'Account': str(ACCOUNT_ID_BASE), 'Arn': 'arn:aws:iam::0:user/benchmark', 'UserId': 'benchmark'}
+
+    def _seal(self, plaintext, encryption_context):
+        return json.dumps(encryption_context or {}, sort_keys=True).encode('utf-8') + b'\0' + plaintext
+
+
+def generate(path, num_vars, num_envs, num_accounts, num_secrets, num_templates, num_pstore):
+    """Write a synthetic envars file, returning its envs and accounts"""
+    envars = EnVars(path)
+    envars.app = 'benchmark'
+    envars.kms_key_arn = 'arn:aws:kms:eu-west-1:000000000000:key/benchmark'
+    envars.envs = [f'env{i}' for i in range(num_envs)]
+    envars.accounts = {str(ACCOUNT_ID_BASE + i): f'account{i}' for i in range(num_accounts)}
+    accounts = list(envars.accounts.values())
+
+    items = []
+    for i in range(num_vars):
+        name = f'VAR_{i:05d}'
+        env = envars.envs[i % num_envs]
+        account = accounts[i % num_accounts]
+        if i < num_secrets:
+            if i % 2:
+                items.append((name, f'secret-{i}', 'default', None))
+            else:
+                items.append((name, f'secret-{i}', env, account))
+            continue
+        if i < num_secrets + num_pstore:
+            envars.add(name, f'parameter_store:/benchmark/{{{{ STAGE }}}}/{name}')
+        elif i < num_secrets + num_pstore + num_templates:
+            envars.add(name, f'https://{{{{ VAR_{i - 1:05d} }}}}/{{{{ STAGE }}}}')
+        else:
+            envars.add(name, f'value-{i}')
+        if i % 3 == 0:
+            envars.add(name, f'value-{i}-{env}', env)
+        if i % 5 == 0:
+            envars.add(name, f'value-{i}-{env}-{account}', env, account=account)
+
+    from envars.models import encryption_context
+    ciphertexts = envars.encrypt_secrets([
+        (plaintext, encryption_context(envars.app, env, account)) for _, plaintext, env, account in items
+    ])
+    for (name, _, env, account), ciphertext in zip(items, ciphertexts):
+        envars.add(name, ciphertext, env, account=account)
+    envars.save()
+    return envars.envs, accounts
+
+
+def run_cli(argv):
+    with contextlib.redirect_stdout(io.StringIO()):
+        sys.argv = ['envars'] + argv
+        cli.main()
+
+
+def benchmarks(path, envs, accounts, tmp):
+    env = envs[0]
+    account = accounts[0]
+
+    def loaded():
+        envars = EnVars(path)
+        envars.load()
+        return envars
+
+    def snapshotted():
+        from envars.snapshot import compile_snapshot
+        snapshot = os.path.join(tmp, 'snapshot')
+        os.makedirs(snapshot, exist_ok=True)
+        copy = os.path.join(snapshot, 'envars.yml')
+        if not os.path.exists(copy):
+            shutil.copy(path, copy)
+            with open(copy, 'rb') as f:
+                content = f.read()
+            envars = EnVars(copy)
+            envars.load()
+            compile_snapshot(envars, content)
+        return copy
+
+    def load_snapshot():
+        copy = snapshotted()
+        return lambda: EnVars(copy).load()
+
+    def load_snapshot_table():
+        copy = snapshotted()
+
+        def run():
+            envars = EnVars(copy)
+            envars.load()
+            envars.table(env, account)
+        return run
+
+    def save():
+        envars = loaded()
+        envars.filename = os.path.join(tmp, 'saved.yml')
+        return envars.save
+
+    def add_save():
+        envars = loaded()
+        envars.filename = os.path.join(tmp, 'saved.yml')
+        values = iter(range(1000000))
+        return lambda: (envars.add('VAR_00001', f'changed-{next(values)}', envs[-1]), envars.save())
+
+    def prepared(method):
+        def setup():
+            envars = loaded()
+            return lambda: method(envars)
+        return setup
+
+    template_vars = {'STAGE': env}
+    return [
+        ('load', lambda: loaded),
+        ('load snapshot', load_snapshot),
+        ('load table', lambda: lambda: loaded().table(env, account)),
+        ('load snapshot table', load_snapshot_table),
+        ('build_env', prepared(lambda e: e.build_env(env, account, template_vars=template_vars))),
+        ('build_env decrypt', prepared(lambda e: e.build_env(env, account, decrypt=True, template_vars=template_vars))),
+        ('build_all decrypt', prepared(lambda e: e.build_all(decrypt=True))),
+        ('print', prepared(lambda e: e.print(account))),
+        ('save', save),
+        ('add save', add_save),
+        ('cli validate', lambda: lambda: run_cli(['-f', path, 'validate'])),
+        ('cli print', lambda: lambda: run_cli(['-f', path, 'print', '-e', env, '-a', account, '--no-agent'])),
+        ('cli print decrypt', lambda: lambda: run_cli(['-f', path, 'print', '-e', env, '-a', account, '--no-agent', '-d'])),
+        ('cli print all-envs', lambda: lambda: run_cli(['-f', path, 'print', '--all-envs', '-d', '--output-dir', f'{tmp}/out'])),
+    ]
+
+
+def measure(stand_ins, setup, repeat):
+    best = None
+    for _ in range(repeat):
+        run = setup()
+        stand_ins.reset()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    calls = dict(stand_ins.calls)
+
+    run = setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'wall': round(best, 6), 'calls': calls, 'peak_kib': peak // 1024}
+
+
+def slower_fast_paths(results):
+    return [
+        f'{name}: {results[name]["wall"]:.4f}s is not faster than {other} {results[other]["wall"]:.4f}s'
+        for name, other in MUST_BEAT
+        if name in results and other in results and results[name]['wall'] >= results[other]['wall']
+    ]
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['wall'] > before['wall'] * (1 + threshold):
+            regressions.append(f'{name}: wall {before["wall"]:.4f}s -> {result["wall"]:.4f}s')
+        for call, count in result['calls'].items():
+            if count > before['calls'].get(call, 0):
+                regressions.append(f'{name}: {call} calls {before["calls"].get(call, 0)} -> {count}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='envars benchmark suite')
+    parser.add_argument(
+        '--vars',
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        '--envs',
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '--accounts',
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        '--secrets',
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        '--templates',
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        '--pstore',
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=20,
+        help='milliseconds added to every stand-in AWS call',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        '--only',
+        action='append',
+        default=None,
+        help='run only the named benchmark, may be repeated',
+    )
+    parser.add_argument(
+        '--baseline',
+        default=None,
+        help='compare against this baseline file',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.2,
+        help='allowed slowdown against the baseline, 0.2 is 20%%',
+    )
+    parser.add_argument(
+        '--save-baseline',
+        default=None,
+        help='write the results to this baseline file',
+    )
+    args = parser.parse_args()
+
+    params = {k: getattr(args, k) for k in ['vars', 'envs', 'accounts', 'secrets', 'templates', 'pstore', 'latency']}
+    stand_ins = StandIns()
+    stand_ins.install()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['ENVARS_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        os.environ['ENVARS_AGENT_SOCKET'] = os.path.join(tmp, 'no-agent.sock')
+        path = os.path.join(tmp, 'envars.yml')
+        envs, accounts = generate(path, args.vars, args.envs, args.accounts, args.secrets, args.templates, args.pstore)
+        stand_ins.latency = args.latency / 1000
+
+        results = {}
+        print(f'{"benchmark":<20} {"wall (s)":>10} {"peak (KiB)":>11}  calls')
+        for name, setup in benchmarks(path, envs, accounts, tmp):
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(stand_ins, setup, args.repeat)
+            calls = ', '.join(f'{call}={count}' for call, count in sorted(results[name]['calls'].items()))
+            print(f'{name:<20} {results[name]["wall"]:>10.4f} {results[name]["peak_kib"]:>11}  {calls}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    regressions = slower_fast_paths(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print(f'warning: baseline was recorded with {baseline["params"]}')
+        regressions += compare(results, baseline['results'], args.threshold)
+    for regression in regressions:
+        print(f'regression: {regression}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
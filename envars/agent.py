@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from .cache import cache_dir, runtime_dir
+
+DEFAULT_TTL = 300
+CLIENT_TIMEOUT = 60
+
+
+def socket_path(filename):
+    """Default agent socket for an envars file, in the per-user runtime dir"""
+    if os.environ.get('ENVARS_AGENT_SOCKET'):
+        return os.environ['ENVARS_AGENT_SOCKET']
+    digest = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(runtime_dir() or cache_dir(), f'agent-{digest}.sock')
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+def encode_values(values):
+    """JSON safe copy of values, secrets left encrypted are sent as {"secret": ciphertext}"""
+    from .models import Secret
+    return {name: {'secret': value.value} if isinstance(value, Secret) else value for name, value in values.items()}
+
+
+def decode_values(values):
+    from .models import Secret
+    return {name: Secret(value['secret']) if isinstance(value, dict) else value for name, value in values.items()}
+
+
+def request(path, payload, timeout=CLIENT_TIMEOUT):
+    """Send one JSON request to the agent at path, raising AgentUnavailable if it can't be reached"""
+    if not os.path.exists(path):
+        raise AgentUnavailable(f'no agent socket {path}')
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except OSError as e:
+        raise AgentUnavailable(f'agent {path}: {e}')
+    if not line:
+        raise AgentUnavailable(f'agent {path} closed the connection')
+    response = json.loads(line)
+    if 'unavailable' in response:
+        raise AgentUnavailable(response['unavailable'])
+    if 'error' in response:
+        raise (Exception(response['error']))
+    return decode_values(response['values'])
+
+
+def listening(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def fetch_env(filename, env, account, names=None, decrypt=False, template_vars=None, check_env=True, path=None):
+    """Resolve env through a running agent, returning None when there is none"""
+    try:
+        return request(path or socket_path(filename), {
+            'filename': os.path.abspath(filename),
+            'env': env,
+            'account': account,
+            'names': names,
+            'decrypt': decrypt,
+            'template_vars': template_vars or {},
+            'check_env': check_env,
+        })
+    except AgentUnavailable as e:
+        logging.debug(f'{e}, resolving directly')
+        return None
+
+
+class EnvarsAgent(object):
+    """
+    Keeps an envars file loaded and its resolved environments in memory for
+    ttl seconds, reloading the file when it changes on disk.
+    """
+
+    def __init__(self, filename, ttl=DEFAULT_TTL, configure=None):
+        self.filename = os.path.abspath(filename)
+        self.ttl = ttl
+        self.configure = configure
+        self.envars = None
+        self.mtime = None
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        from .models import EnVars
+        mtime = os.stat(self.filename).st_mtime_ns
+        if self.envars is None or mtime != self.mtime:
+            logging.debug(f'agent loading {self.filename}')
+            envars = EnVars(self.filename)
+            envars.load()
+            if self.configure:
+                self.configure(envars)
+            self.envars = envars
+            self.mtime = mtime
+            self.values = {}
+        return self.envars
+
+    def resolve(self, env, account=None, names=None, decrypt=False, template_vars=None, check_env=True):
+        with self._lock:
+            envars = self.load()
+            if check_env and env not in envars.envs:
+                raise (Exception(f'Unknown Env: "{env}"'))
+            if account is None:
+                from .envars import get_account
+                account = get_account(envars)
+
+            key = json.dumps([env, account, names, decrypt, sorted((template_vars or {}).items())])
+            entry = self.values.get(key)
+            if entry and entry[1] >= time.monotonic():
+                return entry[0]
+
+            if names:
+                values = envars.resolve(env, account, names, decrypt=decrypt, template_vars=template_vars)
+            else:
+                values = envars.build_env(env, account, decrypt=decrypt, template_vars=template_vars)
+            self.values[key] = (values, time.monotonic() + self.ttl)
+            return values
+
+    def handle(self, payload):
+        if payload.get('filename') != self.filename:
+            return {'unavailable': f'agent serves {self.filename}'}
+        try:
+            return {'values': encode_values(self.resolve(
+                payload['env'],
+                account=payload.get('account'),
+                names=payload.get('names'),
+                decrypt=payload.get('decrypt', False),
+                template_vars=payload.get('template_vars'),
+                check_env=payload.get('check_env', True),
+            ))}
+        except Exception as e:
+            logging.debug(f'agent request failed: {e}')
+            return {'error': str(e)}
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            response = self.server.agent.handle(json.loads(line))
+        except ValueError as e:
+            response = {'error': f'invalid request: {e}'}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            if listening(path):
+                raise (Exception(f'An agent is already listening on {path}'))
+            os.remove(path)
+        # only the owner may connect, the agent hands out decrypted secrets
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,59 @@
+import os
+import sys
+import threading
+
+# seconds, so a hung KMS/SSM/STS call fails instead of blocking envars
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+_session = None
+_clients = {}
+_client_hooks = []
+_lock = threading.Lock()
+
+
+def session():
+    global _session
+    if _session is None:
+        import boto3
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(name):
+    """Return the shared client for an AWS service, created on first use"""
+    try:
+        return _clients[name]
+    except KeyError:
+        pass
+
+    from botocore.config import Config
+    from botocore.exceptions import NoCredentialsError, ProfileNotFound
+    with _lock:
+        if name not in _clients:
+            config = Config(
+                connect_timeout=float(os.environ.get('ENVARS_AWS_CONNECT_TIMEOUT', CONNECT_TIMEOUT)),
+                read_timeout=float(os.environ.get('ENVARS_AWS_READ_TIMEOUT', READ_TIMEOUT)),
+            )
+            try:
+                client = session().client(name, config=config)
+            except (ProfileNotFound, NoCredentialsError):
+                print('AWS credentials not found, is AWS_PROFILE set? does "~/.aws/credentials" exist?')
+                sys.exit(1)
+            for hook in _client_hooks:
+                hook(client)
+            _clients[name] = client
+        return _clients[name]
+
+
+def add_client_hook(hook):
+    """Call hook with every client, those already created and those created later"""
+    with _lock:
+        _client_hooks.append(hook)
+        for client in _clients.values():
+            hook(client)
+
+
+def remove_client_hook(hook):
+    with _lock:
+        _client_hooks.remove(hook)
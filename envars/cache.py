@@ -0,0 +1,203 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .files import atomic_write
+
+CACHE_VERSION = 1
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+
+def cache_dir():
+    if os.environ.get('ENVARS_CACHE_DIR'):
+        return os.environ['ENVARS_CACHE_DIR']
+    xdg_cache = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(xdg_cache, 'envars')
+
+
+def runtime_dir():
+    """The per-user tmpfs envars directory, None when there isn't one"""
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'envars')
+    return None
+
+
+def _write_private(path, data):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    atomic_write(path, data, mode=0o600)
+
+
+class SecretCache(object):
+    """
+    On-disk cache of decrypted secrets, encrypted with AES-GCM under a KMS
+    data key that is regenerated once per TTL window.
+
+    The plaintext data key is only kept in the per-user runtime dir (a tmpfs),
+    never next to the cache. Without a runtime dir every process unwraps it
+    with one KMS Decrypt.
+    """
+
+    def __init__(self, kms_agent, app, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, directory=None):
+        self.kms_agent = kms_agent
+        self.app = app
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory or cache_dir()
+        self.path = os.path.join(self.directory, f'{app}.cache')
+        self.key_path = None
+        key_directory = runtime_dir()
+        if key_directory and os.path.abspath(key_directory) != os.path.abspath(self.directory):
+            self.key_path = os.path.join(key_directory, f'{app}.key')
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._data_key = None
+        self._encrypted_data_key = None
+        self._key_created = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(base64_ciphertext, encryption_context):
+        hasher = hashlib.sha256(base64_ciphertext.encode('utf-8'))
+        hasher.update(json.dumps(sorted(encryption_context.items())).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def get(self, base64_ciphertext, encryption_context):
+        key = self.cache_key(base64_ciphertext, encryption_context)
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, base64_ciphertext, encryption_context, plaintext):
+        key = self.cache_key(base64_ciphertext, encryption_context)
+        with self._lock:
+            entries = self._load()
+            entries[key] = [plaintext, time.time() + self.ttl]
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+            self._ensure_data_key()
+            now = time.time()
+            entries = OrderedDict((k, v) for k, v in self._entries.items() if v[1] >= now)
+            nonce = os.urandom(12)
+            data = AESGCM(self._data_key).encrypt(nonce, json.dumps(list(entries.items())).encode('utf-8'), None)
+            _write_private(self.path, json.dumps({
+                'version': CACHE_VERSION,
+                'created': self._key_created,
+                'encrypted_key': self._encrypted_data_key,
+                'nonce': base64.b64encode(nonce).decode('utf-8'),
+                'data': base64.b64encode(data).decode('utf-8'),
+            }))
+            self._dirty = False
+
+    def clear(self):
+        with self._lock:
+            for path in [self.path, self.key_path]:
+                if path is None:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._entries = OrderedDict()
+            self._data_key = None
+            self._dirty = False
+
+    def stats(self):
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            return {
+                'path': self.path,
+                'entries': len([v for v in entries.values() if v[1] >= now]),
+                'expired': len([v for v in entries.values() if v[1] < now]),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'size': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+                'key_age': int(now - self._key_created) if self._key_created else None,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = OrderedDict()
+        try:
+            with open(self.path) as f:
+                header = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return self._entries
+
+        if header.get('version') != CACHE_VERSION or header['created'] + self.ttl < time.time():
+            logging.debug('secret cache expired')
+            return self._entries
+
+        try:
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+            self._read_data_key(header)
+            data = AESGCM(self._data_key).decrypt(
+                base64.b64decode(header['nonce']),
+                base64.b64decode(header['data']),
+                None,
+            )
+            self._entries = OrderedDict(json.loads(data))
+        except Exception as e:
+            logging.debug(f'secret cache unreadable: {e}')
+            self._data_key = None
+        return self._entries
+
+    def _read_data_key(self, header):
+        if self.key_path:
+            try:
+                with open(self.key_path) as f:
+                    key_file = json.load(f)
+                if key_file['encrypted_key'] == header['encrypted_key']:
+                    self._data_key = base64.b64decode(key_file['key'])
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+
+        if self._data_key is None:
+            # no runtime dir, or the key file was lost (e.g. a reboot cleared it), unwrap it with one KMS call
+            self._data_key = self.kms_agent.decrypt_data_key(header['encrypted_key'], self._key_context())
+            self._write_key_file(header['encrypted_key'])
+        self._encrypted_data_key = header['encrypted_key']
+        self._key_created = header['created']
+
+    def _ensure_data_key(self):
+        if self._data_key is not None and self._key_created + self.ttl >= time.time():
+            return
+        self._data_key, self._encrypted_data_key = self.kms_agent.generate_data_key(self._key_context())
+        self._key_created = int(time.time())
+        self._write_key_file(self._encrypted_data_key)
+
+    def _write_key_file(self, encrypted_key):
+        if self.key_path is None:
+            return
+        _write_private(self.key_path, json.dumps({
+            'key': base64.b64encode(self._data_key).decode('utf-8'),
+            'encrypted_key': encrypted_key,
+        }))
+
+    def _key_context(self):
+        return {'app': self.app, 'purpose': 'envars-secret-cache'}
@@ -3,13 +3,14 @@ import argparse
 import logging
 import os
 import re
-import subprocess
+import signal
 import sys
 
-import boto3
 import yaml
 
-from .models import EnVars
+from . import timings
+from .importer import FORMATS, guess_format, parse_entries
+from .models import EnVars, dump, get_loader
 
 try:
     from collections.abc import Iterable
@@ -32,9 +33,48 @@ def main():
         '--debug',
         action='store_true',
     )
+    parser.add_argument(
+        '--cache-ttl',
+        type=int,
+        default=int(os.environ.get('ENVARS_CACHE_TTL', 0)),
+        help='cache decrypted secrets on disk for this many seconds (0 disables)',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=None,
+        help='maximum number of cached secrets',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help='directory for the secret cache',
+    )
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        help='report phase durations and AWS call statistics',
+    )
+    parser.add_argument(
+        '--timings-format',
+        choices=['text', 'json'],
+        default='text',
+    )
+    parser.add_argument(
+        '--timings-file',
+        default=None,
+        help='write the timings report to this file instead of stderr',
+    )
+    parser.add_argument(
+        '--profile',
+        default=None,
+        metavar='PATH',
+        help='write a cProfile of the command to PATH and a per-variable cost report to PATH.variables.json',
+    )
 
     subparsers = parser.add_subparsers(
         title="commands",
+        dest='command',
     )
 
     #
@@ -96,6 +136,58 @@ def main():
     )
     parser_add.set_defaults(func=add_var)
 
+    #
+    # import envars subparser
+    #
+    parser_import = subparsers.add_parser(
+        'import',
+        help='add many variables to envars file',
+    )
+    parser_import.add_argument(
+        '-a',
+        '--account',
+        required=False,
+        default=None,
+    )
+    parser_import.add_argument(
+        '-d',
+        '--desc',
+        required=False,
+    )
+    parser_import.add_argument(
+        '-e',
+        '--env',
+        required=False,
+        default='default',
+    )
+    parser_import.add_argument(
+        '-s',
+        '--secret',
+        required=False,
+        action='store_true',
+    )
+    parser_import.add_argument(
+        '--format',
+        required=False,
+        choices=FORMATS,
+        default=None,
+        help='input format, guessed from the file extension by default',
+    )
+    parser_import.add_argument(
+        '--kms-concurrency',
+        required=False,
+        type=int,
+        default=None,
+        help='number of concurrent KMS encrypt calls',
+    )
+    parser_import.add_argument(
+        'input',
+        nargs='?',
+        default='-',
+        help='file to import, "-" for stdin',
+    )
+    parser_import.set_defaults(func=import_vars)
+
     #
     # print env subparser
     #
@@ -137,7 +229,9 @@ def main():
         '-v',
         '--var',
         required=False,
+        action='append',
         default=None,
+        help='only resolve this variable, may be repeated or comma separated',
     )
     parser_print.add_argument(
         '-y',
@@ -152,6 +246,50 @@ def main():
         default=False,
         action='store_true',
     )
+    parser_print.add_argument(
+        '--kms-concurrency',
+        required=False,
+        type=int,
+        default=None,
+        help='number of concurrent KMS decrypt calls',
+    )
+    parser_print.add_argument(
+        '--pstore-by-path',
+        required=False,
+        type=int,
+        default=None,
+        help='use GetParametersByPath when this many parameters share a path',
+    )
+    parser_print.add_argument(
+        '--all-envs',
+        required=False,
+        action='store_true',
+        help='print every env and account combination',
+    )
+    parser_print.add_argument(
+        '--accounts',
+        required=False,
+        default=None,
+        help='comma separated accounts for --all-envs, all configured accounts by default',
+    )
+    parser_print.add_argument(
+        '--output-dir',
+        required=False,
+        default=None,
+        help='with --all-envs, write each combination to DIR/ENV-ACCOUNT.env',
+    )
+    parser_print.add_argument(
+        '--socket',
+        required=False,
+        default=None,
+        help='envars agent socket to resolve through',
+    )
+    parser_print.add_argument(
+        '--no-agent',
+        required=False,
+        action='store_true',
+        help='always resolve directly, even if an envars agent is running',
+    )
     parser_print.set_defaults(func=print_env)
 
     #
@@ -175,7 +313,9 @@ def main():
         '-v',
         '--var',
         required=False,
+        action='append',
         default=None,
+        help='only resolve this variable, may be repeated or comma separated',
     )
     parser_exec.add_argument(
         '-a',
@@ -191,6 +331,45 @@ def main():
         action='append',
         default=[],
     )
+    parser_exec.add_argument(
+        '--kms-concurrency',
+        required=False,
+        type=int,
+        default=None,
+        help='number of concurrent KMS decrypt calls',
+    )
+    parser_exec.add_argument(
+        '--pstore-by-path',
+        required=False,
+        type=int,
+        default=None,
+        help='use GetParametersByPath when this many parameters share a path',
+    )
+    parser_exec.add_argument(
+        '--socket',
+        required=False,
+        default=None,
+        help='envars agent socket to resolve through',
+    )
+    parser_exec.add_argument(
+        '--no-agent',
+        required=False,
+        action='store_true',
+        help='always resolve directly, even if an envars agent is running',
+    )
+    parser_exec.add_argument(
+        '--refresh-interval',
+        required=False,
+        type=int,
+        default=None,
+        help='run command as a child and poll parameter store values every this many seconds',
+    )
+    parser_exec.add_argument(
+        '--on-change',
+        required=False,
+        default='restart',
+        help='when parameter store values change: "restart" the command or send it "signal:NAME"',
+    )
     parser_exec.add_argument('command', nargs=argparse.REMAINDER)
     parser_exec.set_defaults(func=execute)
 
@@ -215,7 +394,9 @@ def main():
         '-v',
         '--var',
         required=False,
+        action='append',
         default=None,
+        help='only resolve this variable, may be repeated or comma separated',
     )
     parser_set_systemd_env.add_argument(
         '-a',
@@ -231,8 +412,120 @@ def main():
         action='append',
         default=[],
     )
+    parser_set_systemd_env.add_argument(
+        '--kms-concurrency',
+        required=False,
+        type=int,
+        default=None,
+        help='number of concurrent KMS decrypt calls',
+    )
+    parser_set_systemd_env.add_argument(
+        '--pstore-by-path',
+        required=False,
+        type=int,
+        default=None,
+        help='use GetParametersByPath when this many parameters share a path',
+    )
+    parser_set_systemd_env.add_argument(
+        '--socket',
+        required=False,
+        default=None,
+        help='envars agent socket to resolve through',
+    )
+    parser_set_systemd_env.add_argument(
+        '--no-agent',
+        required=False,
+        action='store_true',
+        help='always resolve directly, even if an envars agent is running',
+    )
+    parser_set_systemd_env.add_argument(
+        '--environment-file',
+        required=False,
+        default=None,
+        help='write a systemd EnvironmentFile instead of calling systemctl set-environment',
+    )
     parser_set_systemd_env.set_defaults(func=set_systemd_env)
 
+    #
+    # agent subparser
+    #
+    parser_agent = subparsers.add_parser(
+        'agent',
+        help='serve resolved environments over a unix socket',
+    )
+    parser_agent.add_argument(
+        '--socket',
+        required=False,
+        default=None,
+        help='path of the unix socket to listen on',
+    )
+    parser_agent.add_argument(
+        '--ttl',
+        required=False,
+        type=int,
+        default=300,
+        help='seconds to keep a resolved environment before resolving it again',
+    )
+    parser_agent.add_argument(
+        '--kms-concurrency',
+        required=False,
+        type=int,
+        default=None,
+        help='number of concurrent KMS decrypt calls',
+    )
+    parser_agent.add_argument(
+        '--pstore-by-path',
+        required=False,
+        type=int,
+        default=None,
+        help='use GetParametersByPath when this many parameters share a path',
+    )
+    parser_agent.set_defaults(func=agent)
+
+    #
+    # cache subparser
+    #
+    parser_cache = subparsers.add_parser(
+        'cache',
+        help='manage the local secret cache',
+    )
+    parser_cache.add_argument(
+        'action',
+        choices=['clear', 'stats'],
+    )
+    parser_cache.set_defaults(func=cache)
+
+    #
+    # migrate subparser
+    #
+    parser_migrate = subparsers.add_parser(
+        'migrate',
+        help='re-encrypt secrets in envars file',
+    )
+    parser_migrate.add_argument(
+        '--envelope',
+        required=True,
+        action='store_true',
+        help='encrypt secrets locally under per env/account KMS data keys',
+    )
+    parser_migrate.set_defaults(func=migrate)
+
+    #
+    # compile subparser
+    #
+    parser_compile = subparsers.add_parser(
+        'compile',
+        help='write a precompiled snapshot of envars file',
+    )
+    parser_compile.add_argument(
+        '-o',
+        '--output',
+        required=False,
+        default=None,
+        help='snapshot path, defaults to the envars file name with a .snapshot suffix',
+    )
+    parser_compile.set_defaults(func=compile_envars)
+
     #
     # validate subparser
     #
@@ -243,12 +536,28 @@ def main():
     parser_validate.set_defaults(func=validate)
 
     args = parser.parse_args()
-    if len(vars(args)) == 2:
+    if not hasattr(args, 'func'):
         parser.print_help()
         sys.exit(0)
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
-    args.func(args)
+    if args.timings:
+        timings.enable(args.command)
+    if args.profile:
+        from .profiling import Profiler
+        args.profiler = Profiler(args.profile)
+        args.profiler.start()
+    try:
+        args.func(args)
+    finally:
+        report(args)
+
+
+def report(args):
+    if getattr(args, 'timings', False):
+        timings.write(args.timings_format, args.timings_file)
+    if getattr(args, 'profiler', None):
+        args.profiler.write()
 
 
 def set_systemd_env(args):
@@ -260,14 +569,18 @@ def set_systemd_env(args):
     if not args.env:
         print('STAGE=<env> or -e <env> must be supplied')
         sys.exit(1)
-    args.var = None
+    vals = {}
     ret = process(args)
     for val in ret:
         parts = val.split("=", 1)
-        subprocess.run(
-            f"systemctl set-environment {parts[0]}='{parts[1]}'",
-            shell=True,
-        )
+        vals[parts[0]] = parts[1]
+
+    from .systemd import set_environment, write_environment_file
+    with timings.phase('output'):
+        if getattr(args, 'environment_file', None):
+            write_environment_file(args.environment_file, vals)
+        else:
+            set_environment(vals)
 
 
 def execute(args):
@@ -281,22 +594,68 @@ def execute(args):
         print('STAGE=<env> or -e <env> must be supplied')
         sys.exit(1)
 
+    if getattr(args, 'refresh_interval', None):
+        return watch(args)
+
     vals = {}
-    if args.var:
-        envars = EnVars(args.filename)
-        envars.load()
-        vals = envars.get_var(args.var, args.env, args.account)
-    else:
-        args.var = None
-        ret = process(args)
-        for val in ret:
-            parts = val.split("=", 1)
-            vals[parts[0]] = parts[1]
+    ret = process(args)
+    for val in ret:
+        parts = val.split("=", 1)
+        vals[parts[0]] = parts[1]
 
     os.environ.update(vals)
+    # exec replaces this process, so report now
+    report(args)
     os.execlp(command[0], *command)
 
 
+def watch(args):
+    from .watch import ParameterWatcher, Supervisor, parse_on_change
+    on_change = parse_on_change(args.on_change)
+
+    # resolve once, after that only the parameter store values are polled
+    # and the templates re-rendered, secrets are not decrypted again
+    envars = load_envars(args)
+    account = args.account if args.account is not None else get_account(envars)
+    template_vars = template_variables(args, args.env)
+    names = requested_vars(args)
+    for name in names or []:
+        if name not in envars.index:
+            raise (Exception(f'Unknown Var: "{name}"'))
+    plan = envars.plan(args.env, account)
+    watcher = ParameterWatcher(envars, args.env, account, names=names, template_vars=template_vars)
+    watcher.poll()
+    selected, values = plan.fetch(envars, decrypt=True, template_vars=template_vars, names=names, pstore=watcher.values)
+    envars.kms_agent.flush()
+
+    def environment():
+        return child_environment(args, plan.render(selected, values, decrypt=True, template_vars=template_vars, names=names))
+
+    supervisor = Supervisor(args.command, environment(), on_change)
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, supervisor.forward)
+    supervisor.start()
+
+    try:
+        while True:
+            returncode = supervisor.wait(args.refresh_interval)
+            if returncode is not None:
+                sys.exit(returncode)
+            if watcher.poll() and plan.update_pstore(values, watcher.values):
+                supervisor.changed(environment())
+    finally:
+        # don't leave the child running unsupervised if envars fails
+        supervisor.stop()
+
+
+def child_environment(args, values):
+    env = dict(os.environ)
+    for val in format_values(args, values):
+        parts = val.split("=", 1)
+        env[parts[0]] = parts[1]
+    return env
+
+
 def validate(args):
     envars = EnVars(args.filename)
     envars.load()
@@ -316,18 +675,58 @@ def validate(args):
 
             if isinstance(var.envs[env], dict):
                 for account in var.envs[env]:
-                    if account not in ['master', 'sandbox']:
+                    if account not in envars.account_names():
                         errors.append(f'"{var.name}" "{env}" has invalid account "{account}"')
 
                     if var.envs[env][account] == '':
                         errors.append(f'"{var.name}" "{env}" "{account}" has unsupported empty string')
 
+    for env, account in envars.tables(accounts=envars.account_names()):
+        try:
+            envars.plan(env, account).check()
+        except Exception as e:
+            errors.append(f'"{env}" "{account}" {e}')
+
     if errors:
         for error in errors:
             print(f'Error in devops/env_vars.yml: {error}')
         sys.exit(1)
 
 
+def cache(args):
+    envars = EnVars(args.filename)
+    envars.load()
+    configure(envars, args)
+    secret_cache = envars.kms_agent.secret_cache
+    if secret_cache is None:
+        from .cache import SecretCache
+        secret_cache = SecretCache(envars.kms_agent, envars.app, directory=args.cache_dir)
+
+    if args.action == 'clear':
+        secret_cache.clear()
+    else:
+        for key, value in secret_cache.stats().items():
+            print(f'{key}: {value}')
+
+
+def migrate(args):
+    envars = EnVars(args.filename)
+    envars.load()
+    configure(envars, args)
+    count = envars.migrate_envelope()
+    envars.save()
+    print(f'{count} secrets migrated to envelope encryption')
+
+
+def compile_envars(args):
+    from .snapshot import compile_snapshot
+    with open(args.filename, 'rb') as f:
+        content = f.read()
+    envars = EnVars(args.filename)
+    envars.populate(yaml.load(content, Loader=get_loader()))
+    print(compile_snapshot(envars, content, path=args.output))
+
+
 def init(args):
     envars = EnVars(args.filename)
     envars.app = args.app
@@ -356,70 +755,196 @@ def add_var(args):
     envars.save()
 
 
+def import_vars(args):
+    if args.input == '-':
+        text = sys.stdin.read()
+        fmt = args.format or 'dotenv'
+    else:
+        with open(args.input) as f:
+            text = f.read()
+        fmt = args.format or guess_format(args.input)
+
+    entries = parse_entries(
+        text,
+        fmt,
+        env_name=args.env,
+        account=args.account,
+        is_secret=args.secret,
+        desc=args.desc,
+    )
+    envars = EnVars(args.filename)
+    envars.load()
+    configure(envars, args)
+    envars.add_many(entries)
+    envars.save()
+    print(f'{len(entries)} variables imported')
+
+
 def print_env(args):
+    if getattr(args, 'all_envs', False):
+        return print_all(args)
     ret = process(args)
-    if isinstance(ret, list):
-        for var in ret:
-            print(var)
-    else:
-        print(ret)
+    with timings.phase('output'):
+        if isinstance(ret, list):
+            for var in ret:
+                print(var)
+        else:
+            print(ret)
 
 
 def process(args):
-    check_env = True if args.no_check_env is False else False
-    envars = EnVars(args.filename)
-    envars.load()
-    if check_env and args.env and args.env not in envars.envs:
-        raise (Exception(f'Unknown Env: "{args.env}"'))
-
-    if args.account is None:
-        account = get_account()
-    else:
-        account = args.account
+    check_env = True if getattr(args, 'no_check_env', False) is False else False
 
     if args.env:
-        template_vars = {}
-        for tvar in flatten(args.template_var):
-            template_vars[tvar.split('=')[0]] = tvar.split('=')[1]
-
-        template_vars['STAGE'] = args.env
-        if 'RELEASE_SHA' in os.environ:
-            template_vars['RELEASE'] = os.environ.get('RELEASE_SHA')
-        if 'AWS_REGION' in os.environ:
-            template_vars['AWS_REGION'] = os.environ.get('AWS_REGION')
-        if 'AWS_ACCOUNT_ID' in os.environ:
-            template_vars['AWS_ACCOUNT_ID'] = os.environ.get('AWS_ACCOUNT_ID')
-
-        if args.yaml:
-            return (
-                yaml.dump(
-                    {'envars': envars.build_env(
-                        args.env,
-                        account,
-                        decrypt=args.decrypt,
-                        template_vars=template_vars,
-                    )},
-                    default_flow_style=False
-                )
+        template_vars = template_variables(args, args.env)
+        names = requested_vars(args)
+        values = None
+        if not getattr(args, 'no_agent', False):
+            from .agent import fetch_env
+            values = fetch_env(
+                args.filename,
+                args.env,
+                args.account,
+                names=names,
+                decrypt=args.decrypt,
+                template_vars=template_vars,
+                check_env=check_env,
+                path=getattr(args, 'socket', None),
             )
-        else:
-            env_vars = []
-            for name, value in envars.build_env(
+
+        if values is None:
+            envars = load_envars(args, check_env)
+            account = args.account
+            # only look the account up when a requested variable depends on it
+            if account is None and (not names or envars.account_scoped(args.env, names)):
+                account = get_account(envars)
+            if names:
+                values = envars.resolve(
+                    args.env,
+                    account,
+                    names,
+                    decrypt=args.decrypt,
+                    template_vars=template_vars,
+                )
+            else:
+                values = envars.build_env(
                     args.env,
                     account,
                     decrypt=args.decrypt,
-                    template_vars=template_vars).items():
-                if args.quote:
-                    env_vars.append(f"{name}='{value}'")
-                else:
-                    env_vars.append(f'{name}={value}')
+                    template_vars=template_vars,
+                )
 
-            return env_vars
+        return format_values(args, values)
     else:
-        var = None
-        if args.var:
-            var = args.var.upper()
-        return (envars.print(account, var=var, decrypt=args.decrypt))
+        envars = load_envars(args, check_env)
+        account = args.account if args.account is not None else get_account(envars)
+        return (envars.print(account, var=requested_vars(args), decrypt=args.decrypt))
+
+
+def template_variables(args, env):
+    template_vars = {}
+    for tvar in flatten(getattr(args, 'template_var', [])):
+        template_vars[tvar.split('=')[0]] = tvar.split('=')[1]
+
+    template_vars['STAGE'] = env
+    if 'RELEASE_SHA' in os.environ:
+        template_vars['RELEASE'] = os.environ.get('RELEASE_SHA')
+    if 'AWS_REGION' in os.environ:
+        template_vars['AWS_REGION'] = os.environ.get('AWS_REGION')
+    if 'AWS_ACCOUNT_ID' in os.environ:
+        template_vars['AWS_ACCOUNT_ID'] = os.environ.get('AWS_ACCOUNT_ID')
+    return template_vars
+
+
+def format_values(args, values):
+    if args.yaml:
+        return (
+            dump(
+                {'envars': values},
+                default_flow_style=False
+            )
+        )
+    else:
+        env_vars = []
+        for name, value in values.items():
+            if args.quote:
+                env_vars.append(f"{name}='{value}'")
+            else:
+                env_vars.append(f'{name}={value}')
+
+        return env_vars
+
+
+def print_all(args):
+    envars = EnVars(args.filename)
+    envars.load()
+    configure(envars, args)
+    accounts = [account.strip() for account in args.accounts.split(',')] if args.accounts else None
+    results = envars.build_all(
+        accounts=accounts,
+        decrypt=args.decrypt,
+        template_vars=template_variables(args, None),
+    )
+
+    if args.output_dir:
+        from .files import atomic_write
+        os.makedirs(args.output_dir, exist_ok=True)
+    for (env, account), values in results.items():
+        with timings.phase('output'):
+            output = format_values(args, values)
+            if isinstance(output, list):
+                output = ''.join(f'{line}\n' for line in output)
+            if args.output_dir:
+                path = os.path.join(args.output_dir, f'{env}-{account}.{"yml" if args.yaml else "env"}')
+                atomic_write(path, output, mode=0o600 if args.decrypt else None)
+                print(path)
+            else:
+                print(f'# {env} {account}')
+                print(output, end='')
+
+
+def load_envars(args, check_env=True):
+    envars = EnVars(args.filename)
+    envars.load()
+    configure(envars, args)
+    if check_env and args.env and args.env not in envars.envs:
+        raise (Exception(f'Unknown Env: "{args.env}"'))
+    return envars
+
+
+def agent(args):
+    from .agent import AgentServer, EnvarsAgent, socket_path
+    envars_agent = EnvarsAgent(
+        args.filename,
+        ttl=args.ttl,
+        configure=lambda envars: configure(envars, args),
+    )
+    envars_agent.load()
+    path = args.socket or socket_path(args.filename)
+    server = AgentServer(path, envars_agent)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f'envars agent listening on {path}', flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def requested_vars(args):
+    var = getattr(args, 'var', None)
+    if not var:
+        return None
+    if isinstance(var, str):
+        var = [var]
+    return [name.strip().upper() for names in var for name in names.split(',') if name.strip()]
+
+
+def configure(envars, args):
+    envars.kms_concurrency = getattr(args, 'kms_concurrency', None)
+    envars.pstore_by_path_threshold = getattr(args, 'pstore_by_path', None)
+    envars.cache_ttl = getattr(args, 'cache_ttl', None)
+    envars.cache_size = getattr(args, 'cache_size', None)
+    envars.cache_dir = getattr(args, 'cache_dir', None)
 
 
 def flatten(lis):
@@ -431,13 +956,10 @@ def flatten(lis):
             yield item
 
 
-def get_account():
-    sts_client = boto3.client('sts')
-    account = sts_client.get_caller_identity()['Account']
-    if account == '511042647617':
-        return 'master'
-    elif account == '253613363555':
-        return 'sandbox'
+def get_account(envars):
+    from .identity import caller_account_id
+    with timings.phase('account lookup'):
+        return envars.account_ids().get(caller_account_id(directory=envars.cache_dir))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+import base64
+import json
+import os
+import threading
+
+ENVELOPE_PREFIX = 'envelope:'
+
+
+def is_envelope(ciphertext):
+    return ciphertext.lstrip().startswith(ENVELOPE_PREFIX)
+
+
+def data_key_name(encryption_context):
+    name = encryption_context.get('env', 'default')
+    if encryption_context.get('account'):
+        name = f"{name}/{encryption_context['account']}"
+    return name
+
+
+class EnvelopeCipher(object):
+    """
+    Encrypts secrets locally with AES-GCM under one KMS data key per
+    encryption context, so only the data keys need a KMS call.
+    """
+
+    def __init__(self, kms_agent, data_keys):
+        self.kms_agent = kms_agent
+        self.data_keys = data_keys
+        self._plaintext_keys = {}
+        self._lock = threading.Lock()
+
+    def unwrap(self, encryption_contexts):
+        """Decrypt the data keys for the given contexts, one KMS call each"""
+        missing = {}
+        for encryption_context in encryption_contexts:
+            name = data_key_name(encryption_context)
+            if name not in self._plaintext_keys and name not in missing:
+                if name not in self.data_keys:
+                    raise (Exception(f'No envelope data key for "{name}"'))
+                missing[name] = encryption_context
+
+        items = [(self.data_keys[name].value, context) for name, context in missing.items()]
+        for name, key in zip(missing, self.kms_agent.decrypt_data_keys(items)):
+            self._plaintext_keys[name] = key
+
+    def decrypt(self, ciphertext, encryption_context):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.unwrap([encryption_context])
+        blob = base64.b64decode(''.join(ciphertext.split())[len(ENVELOPE_PREFIX):])
+        aesgcm = AESGCM(self._plaintext_keys[data_key_name(encryption_context)])
+        return aesgcm.decrypt(blob[:12], blob[12:], self._aad(encryption_context)).decode('utf-8')
+
+    def encrypt(self, plaintext, encryption_context):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        from .models import Secret
+        name = data_key_name(encryption_context)
+        with self._lock:
+            if name not in self.data_keys:
+                key, encrypted_key = self.kms_agent.generate_data_key(encryption_context)
+                self.data_keys[name] = Secret(self._wrap(encrypted_key))
+                self._plaintext_keys[name] = key
+        self.unwrap([encryption_context])
+
+        nonce = os.urandom(12)
+        aesgcm = AESGCM(self._plaintext_keys[name])
+        blob = nonce + aesgcm.encrypt(nonce, plaintext.encode('utf-8'), self._aad(encryption_context))
+        return self._wrap(ENVELOPE_PREFIX + base64.b64encode(blob).decode('utf-8'))
+
+    def _aad(self, encryption_context):
+        return json.dumps(sorted(encryption_context.items())).encode('utf-8')
+
+    def _wrap(self, text):
+        return "\n".join([text[i:i + 80] for i in range(0, len(text), 80)])
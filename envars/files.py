@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+
+def atomic_write(path, data, mode=None):
+    """
+    Write data to path via a temporary file in the same directory, fsynced
+    and renamed over path so readers never see a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is None:
+            mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o666 & ~current_umask()
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
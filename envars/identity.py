@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from .cache import cache_dir
+from .files import atomic_write
+
+DEFAULT_TTL = 3600
+
+
+def identity_ttl():
+    return int(os.environ.get('ENVARS_IDENTITY_TTL', DEFAULT_TTL))
+
+
+def credential_source():
+    """
+    Hash of the access key id of the credentials boto3 resolves, so another
+    profile, login or role is looked up again. None without credentials.
+    """
+    from .aws import session
+    credentials = session().get_credentials()
+    if credentials is None or not credentials.access_key:
+        return None
+    return hashlib.sha256(credentials.access_key.encode('utf-8')).hexdigest()
+
+
+def caller_account_id(ttl=None, directory=None):
+    """
+    Return the AWS account id of the current credentials, from AWS_ACCOUNT_ID
+    when set, else from sts:GetCallerIdentity cached on disk for ttl seconds
+    per access key id.
+    """
+    if os.environ.get('AWS_ACCOUNT_ID'):
+        return os.environ['AWS_ACCOUNT_ID']
+
+    ttl = identity_ttl() if ttl is None else ttl
+    path = os.path.join(directory or cache_dir(), 'identity.json')
+    key = credential_source() if ttl else None
+
+    identities = {}
+    if key:
+        try:
+            with open(path) as f:
+                identities = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+        entry = identities.get(key)
+        if entry and entry[1] >= time.time():
+            logging.debug(f'cached caller identity {entry[0]}')
+            return entry[0]
+
+    from .aws import get_client
+    account_id = get_client('sts').get_caller_identity()['Account']
+
+    if key:
+        now = time.time()
+        identities = {k: v for k, v in identities.items() if v[1] >= now}
+        identities[key] = [account_id, now + ttl]
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            atomic_write(path, json.dumps(identities), mode=0o600)
+        except OSError as e:
+            logging.debug(f'unable to cache caller identity: {e}')
+    return account_id
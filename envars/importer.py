@@ -0,0 +1,89 @@
+import datetime
+import json
+import re
+
+import yaml
+
+VAR_NAME = re.compile(r'^[A-Z][A-Z|0-9|_]+$')
+FORMATS = ['dotenv', 'json', 'yaml']
+
+
+def guess_format(filename):
+    if filename.endswith('.json'):
+        return 'json'
+    if filename.endswith(('.yml', '.yaml')):
+        return 'yaml'
+    return 'dotenv'
+
+
+def parse_dotenv(text):
+    values = {}
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('export '):
+            line = line[len('export '):].lstrip()
+        if '=' not in line:
+            raise (Exception(f'line {number}: "VAR_NAME=value" expected'))
+        name, value = line.split('=', 1)
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in ['"', "'"]:
+            value = value[1:-1]
+        values[name.strip()] = value
+    return values
+
+
+def scalar(name, value):
+    """The string stored for a JSON/YAML value, which must be a scalar"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if value is None:
+        raise (Exception(f'"{name}" has a null value, quote it for an empty or literal value'))
+    raise (Exception(f'"{name}" value must be a string, number or boolean, not {type(value).__name__}'))
+
+
+def parse_entries(text, fmt, env_name='default', account=None, is_secret=False, desc=None):
+    """
+    Parse dotenv, JSON or YAML text into (name, value, env_name, account,
+    desc, is_secret) entries for EnVars.add_many. JSON and YAML entries may
+    be mappings with value/env/account/secret/description keys overriding
+    the defaults given here.
+    """
+    if fmt == 'dotenv':
+        data = parse_dotenv(text)
+    elif fmt == 'json':
+        data = json.loads(text)
+    else:
+        data = yaml.safe_load(text)
+
+    if isinstance(data, dict):
+        data = [
+            dict(value, name=name) if isinstance(value, dict) else {'name': name, 'value': value}
+            for name, value in data.items()
+        ]
+    if not isinstance(data, list):
+        raise (Exception('a mapping or list of variables expected'))
+
+    entries = []
+    for item in data:
+        name = item.get('name')
+        if not isinstance(name, str) or not VAR_NAME.match(name):
+            raise (Exception(f'invalid variable name "{name}"'))
+        if 'value' not in item:
+            raise (Exception(f'"{name}" has no value'))
+        entries.append((
+            name,
+            scalar(name, item['value']),
+            item.get('env', env_name),
+            item.get('account', account),
+            item.get('description', desc),
+            bool(item.get('secret', is_secret)),
+        ))
+    return entries
@@ -1,30 +1,64 @@
 import base64
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+from .aws import get_client
+from .profiling import resource, secret_key
+from .singleflight import SingleFlight
 
-kms_client = boto3.client('kms')
+DEFAULT_CONCURRENCY = 10
+DEFAULT_RETRIES = 5
+RETRY_BACKOFF = 0.1
+THROTTLING_ERRORS = ['ThrottlingException', 'TooManyRequestsException', 'LimitExceededException']
 
 
 class KMSAgent(object):
 
-    def __init__(self, kms_key_arn):
+    def __init__(self, kms_key_arn, concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, secret_cache=None):
         self.cache = {}
         self.kms_key_arn = kms_key_arn
+        self.concurrency = concurrency
+        self.retries = retries
+        self.secret_cache = secret_cache
+        self.flight = SingleFlight()
 
     def reset(self):
         self.cache = {}
+        self.flight.reset()
 
     def decrypt(self, base64_ciphertext, encryption_context):
+        """Decrypt, sharing one KMS call between every request for the same ciphertext and context"""
+        key = (base64_ciphertext, tuple(sorted(encryption_context.items())))
+        return self.flight.do(key, self._decrypt, base64_ciphertext, encryption_context)
+
+    def _decrypt(self, base64_ciphertext, encryption_context):
+        with resource('decrypt', [secret_key(base64_ciphertext, encryption_context)]):
+            return self._decrypt_uncached(base64_ciphertext, encryption_context)
+
+    def _decrypt_uncached(self, base64_ciphertext, encryption_context):
+        if self.secret_cache:
+            plaintext = self.secret_cache.get(base64_ciphertext, encryption_context)
+            if plaintext is not None:
+                return plaintext
+
         cipher_blob = base64.b64decode(base64_ciphertext.encode('utf-8'))
-        response = kms_client.decrypt(
+        response = self._call(
+            get_client('kms').decrypt,
             CiphertextBlob=cipher_blob,
             EncryptionContext=encryption_context,
         )
         plaintext = response['Plaintext'].decode('utf-8')
         cache_key = self._cache_key(plaintext, encryption_context)
         self.cache[cache_key] = base64_ciphertext
+        if self.secret_cache:
+            self.secret_cache.put(base64_ciphertext, encryption_context, plaintext)
         return plaintext
 
+    def decrypt_many(self, items):
+        """Decrypt (base64_ciphertext, encryption_context) pairs concurrently, preserving order"""
+        return self._map(self.decrypt, items)
+
     def encrypt(self, plaintext, encryption_context):
         cache_key = self._cache_key(plaintext, encryption_context)
         try:
@@ -32,7 +66,8 @@ class KMSAgent(object):
         except KeyError:
             pass
 
-        response = kms_client.encrypt(
+        response = self._call(
+            get_client('kms').encrypt,
             KeyId=self.kms_key_arn,
             Plaintext=plaintext.encode('utf-8'),
             EncryptionContext=encryption_context
@@ -41,5 +76,60 @@ class KMSAgent(object):
         self.cache[cache_key] = base64_ciphertext
         return "\n".join([base64_ciphertext[i:i + 80] for i in range(0, len(base64_ciphertext), 80)])
 
+    def encrypt_many(self, items):
+        """Encrypt (plaintext, encryption_context) pairs concurrently, preserving order"""
+        return self._map(self.encrypt, items)
+
+    def generate_data_key(self, encryption_context):
+        response = self._call(
+            get_client('kms').generate_data_key,
+            KeyId=self.kms_key_arn,
+            KeySpec='AES_256',
+            EncryptionContext=encryption_context,
+        )
+        return response['Plaintext'], base64.b64encode(response['CiphertextBlob']).decode('utf-8')
+
+    def decrypt_data_key(self, base64_ciphertext, encryption_context):
+        response = self._call(
+            get_client('kms').decrypt,
+            CiphertextBlob=base64.b64decode(base64_ciphertext.encode('utf-8')),
+            EncryptionContext=encryption_context,
+        )
+        return response['Plaintext']
+
+    def decrypt_data_keys(self, items):
+        return self._map(self.decrypt_data_key, items)
+
+    def flush(self):
+        logging.debug(f'kms decrypt single-flight {self.flight.stats()}')
+        if self.secret_cache:
+            self.secret_cache.save()
+
+    def _map(self, method, items):
+        if not items:
+            return []
+        if self.concurrency <= 1 or len(items) == 1:
+            return [method(*item) for item in items]
+
+        # every call is bounded by the client's connect and read timeouts, so the batch is too
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as pool:
+            return list(pool.map(lambda item: method(*item), items))
+
+    def _call(self, method, **kwargs):
+        from botocore.exceptions import ClientError, ConnectTimeoutError, ReadTimeoutError
+        attempt = 0
+        while True:
+            try:
+                return method(**kwargs)
+            except (ConnectTimeoutError, ReadTimeoutError) as e:
+                raise (Exception(
+                    f'KMS call timed out: {e} (raise ENVARS_AWS_CONNECT_TIMEOUT or ENVARS_AWS_READ_TIMEOUT to wait longer)'
+                ))
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt >= self.retries:
+                    raise
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
     def _cache_key(self, plaintext, encryption_context):
         return (plaintext,) + tuple(sorted(encryption_context.items()))
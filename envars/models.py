@@ -1,9 +1,12 @@
+import copy
 import logging
 import re
 
-import jinja2
 import yaml
 
+from .profiling import cost, profile, resource, secret_key
+from .templates import precompile, render
+
 logging.getLogger("botocore.parsers").disabled = True
 logging.getLogger("botocore.retryhandler").disabled = True
 logging.getLogger("botocore.endpoint").disabled = True
@@ -18,12 +21,6 @@ logging.getLogger("botocore.regions").disabled = True
 logging.getLogger("urllib3.connectionpool").disabled = True
 
 
-def get_loader():
-    loader = yaml.SafeLoader
-    loader.add_constructor(u'!secret', secret_constructor)
-    return loader
-
-
 class Secret():
 
     def __init__(self, value):
@@ -32,19 +29,111 @@ class Secret():
     def __repr__(self):
         return self.value
 
+    def __eq__(self, other):
+        return isinstance(other, Secret) and self.value == other.value
 
-def secret_representer(dumper, data):
-    return dumper.represent_scalar(u'!secret', u'%s' % data, style='|')
+    def __hash__(self):
+        return hash(self.value)
 
 
-yaml.add_representer(Secret, secret_representer)
+def secret_representer(dumper, data):
+    return dumper.represent_scalar(u'!secret', u'%s' % data, style='|')
 
 
 def secret_constructor(loader, node: yaml.nodes.MappingNode) -> Secret:
     return Secret(loader.construct_scalar(node))
 
 
-yaml.add_constructor(u'!secret', secret_constructor)
+try:
+    from yaml import CSafeDumper as FastDumper
+    from yaml import CSafeLoader as FastLoader
+except ImportError:
+    FastDumper = None
+    FastLoader = None
+
+
+class EnvarsLoader(FastLoader or yaml.SafeLoader):
+    pass
+
+
+class EnvarsDumper(yaml.SafeDumper):
+    pass
+
+
+EnvarsLoader.add_constructor(u'!secret', secret_constructor)
+EnvarsDumper.add_representer(Secret, secret_representer)
+
+if FastDumper:
+    class EnvarsFastDumper(FastDumper):
+        pass
+
+    EnvarsFastDumper.add_representer(Secret, secret_representer)
+
+
+def get_loader():
+    return EnvarsLoader
+
+
+# libyaml folds long double quoted scalars differently to the pure python
+# emitter, these are the only strings it is known to emit identically
+SIMPLE_STRING = re.compile(r'^(?:[\x21-\x7e](?:[\x20-\x7e]*[\x21-\x7e])?)?$')
+SIMPLE_SECRET = re.compile(r'^[A-Za-z0-9+/=:]+(?:\n[A-Za-z0-9+/=:]+)*$')
+
+
+def emits_identically(data):
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, str):
+            if not SIMPLE_STRING.match(item):
+                return False
+        elif isinstance(item, Secret):
+            if not isinstance(item.value, str) or not SIMPLE_SECRET.match(item.value):
+                return False
+        elif item is not None and not isinstance(item, (bool, int, float)):
+            return False
+    return True
+
+
+def dump(data, **kwargs):
+    """yaml.dump with libyaml when it produces the same bytes as the pure python dumper"""
+    kwargs.setdefault('default_flow_style', False)
+    if FastDumper and emits_identically(data):
+        return yaml.dump(data, Dumper=EnvarsFastDumper, **kwargs)
+    return yaml.dump(data, Dumper=EnvarsDumper, **kwargs)
+
+
+# save leaves a blank line before every variable and configuration key
+SPACING = re.compile(r'\n  ([A-Z])')
+
+PSTORE_PREFIX = 'parameter_store:'
+ACCOUNT_IDS = {
+    '511042647617': 'master',
+    '253613363555': 'sandbox',
+}
+ACCOUNTS = list(ACCOUNT_IDS.values())
+
+
+def pstore_name(value, env):
+    """Return the rendered parameter store name referenced by value, if any"""
+    if not isinstance(value, str) or PSTORE_PREFIX not in value:
+        return None
+    return render(value.split(':')[1], {'STAGE': env})
+
+
+def encryption_context(app, env, account):
+    encryption_context = {}
+    encryption_context['app'] = app
+    if env != 'default':
+        encryption_context['env'] = env
+    if account:
+        encryption_context['account'] = account
+    return encryption_context
 
 
 class EnVar:
@@ -62,47 +151,61 @@ class EnVar:
     def __repr__(self):
         return f"EnVar(name='{self.name}', envs={self.envs})"
 
+    def lookup(self, env, account):
+        """Return (value, env, account) for the entry that applies to env/account"""
+        for env_name in [env, 'default']:
+            if env_name not in self.envs:
+                continue
+            if isinstance(self.envs[env_name], dict):
+                if self.envs[env_name].get(account) is not None:
+                    return self.envs[env_name][account], env_name, account
+            elif self.envs[env_name] is not None:
+                return self.envs[env_name], env_name, None
+        return None, None, None
+
     def get_value(self, env, account, decrypt=False, fetch_pstore=False):
-        value = None
-        if env in self.envs:
-            if isinstance(self.envs[env], dict):
-                if account in self.envs[env]:
-                    value = self.decrypt(self.envs[env][account], env, account, decrypt)
-            else:
-                value = self.decrypt(self.envs[env], env, None, decrypt)
-        if value is None and 'default' in self.envs:
-            if isinstance(self.envs['default'], dict):
-                if account in self.envs['default']:
-                    value = self.decrypt(self.envs['default'][account], 'default', account, decrypt)
-            else:
-                value = self.decrypt(self.envs['default'], 'default', None, decrypt)
+        value, env_name, account_name = self.lookup(env, account)
+        if value is not None:
+            value = self.decrypt(value, env_name, account_name, decrypt)
 
-        if value and fetch_pstore and not isinstance(value, Secret):
-            if 'parameter_store:' in value:
+        if value and fetch_pstore:
+            pname = pstore_name(value, env)
+            if pname:
                 from .ssm import SsmAgent
                 ssm_agent = SsmAgent()
-                pname = value.split(':')[1]
-                jenv = jinja2.Environment()
-                pname = jenv.from_string(pname).render({'STAGE': env})
                 value = ssm_agent.fetch(pname)
 
         return value
 
+    def encryption_context(self, env, account):
+        return encryption_context(self.app, env, account)
+
     def decrypt(self, value, env, account, decrypt):
         logging.debug(f'decrypt({value}, {env}, {account})')
         if decrypt and isinstance(value, Secret):
-            from .kms import KMSAgent
-            kms_agent = KMSAgent(self.parent.kms_key_arn)
-            encryption_context = {}
-            encryption_context['app'] = self.app
-            if env != 'default':
-                encryption_context['env'] = env
-            if account:
-                encryption_context['account'] = account
+            encryption_context = self.encryption_context(env, account)
             logging.debug(f'encryption_context({encryption_context})')
-            value = kms_agent.decrypt(value.value, encryption_context)
+            value = self.parent.decrypt_secrets([(value, encryption_context)])[0]
         return value
 
+    def items(self):
+        """Yield (env, account, value) for every value of this variable"""
+        for env_name, value in self.envs.items():
+            if env_name == 'description':
+                continue
+            if isinstance(value, dict):
+                for account_name, account_value in value.items():
+                    yield env_name, account_name, account_value
+            else:
+                yield env_name, None, value
+
+    def set(self, env, account, value):
+        self.parent.changed(self.name)
+        if account:
+            self.envs[env][account] = value
+        else:
+            self.envs[env] = value
+
 
 class EnVars:
 
@@ -110,74 +213,206 @@ class EnVars:
         self.filename = filename
         self.app = None
         self.envs = []
-        self.envars = []
+        self._envars = []
+        self._index = {}
+        self._packed = None
+        self.layouts = {}
         self.kms_key_arn = None
+        self.kms_concurrency = None
+        self.pstore_by_path_threshold = None
+        self.cache_ttl = None
+        self.cache_size = None
+        self.cache_dir = None
+        self.data_keys = None
+        self.accounts = None
+        self._kms_agent = None
+        self._envelope = None
+        # the text last loaded or saved and what has changed since
+        self.source = None
+        self.dirty = set()
+        self._source_config = None
+        self._source_count = 0
+
+    @property
+    def envars(self):
+        if self._packed is not None:
+            self.unpack()
+        return self._envars
+
+    @envars.setter
+    def envars(self, envars):
+        self._packed = None
+        self._envars = envars
+
+    @property
+    def index(self):
+        if self._packed is not None:
+            self.unpack()
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._packed = None
+        self._index = index
+
+    def pack(self, count, packed):
+        """Hold count variables marshalled by a snapshot, unpacked the first time they are used"""
+        self._envars = []
+        self._index = {}
+        self._packed = (count, packed)
+
+    def unpack(self):
+        from .snapshot import unpack_variables
+        _, packed = self._packed
+        self._packed = None
+        unpack_variables(self, packed)
+
+    def count(self):
+        return self._packed[0] if self._packed is not None else len(self._envars)
+
+    @property
+    def kms_agent(self):
+        if self._kms_agent is None:
+            from .kms import DEFAULT_CONCURRENCY, KMSAgent
+            self._kms_agent = KMSAgent(self.kms_key_arn, concurrency=self.kms_concurrency or DEFAULT_CONCURRENCY)
+            self._kms_agent.secret_cache = self.secret_cache()
+        return self._kms_agent
+
+    @property
+    def envelope(self):
+        if self._envelope is None and self.data_keys is not None:
+            from .envelope import EnvelopeCipher
+            self._envelope = EnvelopeCipher(self.kms_agent, self.data_keys)
+        return self._envelope
+
+    def account_ids(self):
+        """Map of AWS account id to account name, from ACCOUNTS in the configuration block"""
+        return self.accounts if self.accounts is not None else ACCOUNT_IDS
+
+    def account_names(self):
+        return list(dict.fromkeys(self.account_ids().values()))
+
+    def secret_cache(self):
+        if not self.cache_ttl:
+            return None
+        from .cache import DEFAULT_MAX_ENTRIES, SecretCache
+        return SecretCache(
+            self._kms_agent,
+            self.app,
+            ttl=self.cache_ttl,
+            max_entries=self.cache_size or DEFAULT_MAX_ENTRIES,
+            directory=self.cache_dir,
+        )
 
     def load(self):
         with open(self.filename, "rb") as envars_yml:
-            envars_file = yaml.load(envars_yml, Loader=get_loader())
+            content = envars_yml.read()
+
+        from .snapshot import load_snapshot
+        from .timings import phase
+        with phase('load'):
+            if load_snapshot(self, content):
+                logging.debug(f'loaded snapshot of {self.filename}')
+            else:
+                self.populate(yaml.load(content, Loader=get_loader()))
+        self.track(content)
+
+    def track(self, source):
+        """Remember source as the file text the variables were loaded from or saved to"""
+        self.source = source
+        self.dirty = set()
+        self._source_config = copy.deepcopy(self.configuration())
+        self._source_count = self.count()
 
+    def populate(self, envars_file):
         config = envars_file["configuration"]
         self.app = config['APP']
         self.kms_key_arn = config['KMS_KEY_ARN']
         self.envs = config['ENVIRONMENTS']
+        self.data_keys = config.get('DATA_KEYS')
+        self.accounts = None
+        if config.get('ACCOUNTS') is not None:
+            self.accounts = {str(account_id): name for account_id, name in config['ACCOUNTS'].items()}
+        self.envars = []
+        self.index = {}
+        self.layouts = {}
         for var in envars_file['environment_variables']:
             desc = None
             if 'description' in envars_file['environment_variables'][var]:
                 desc = envars_file['environment_variables'][var]['description']
-            self.envars.append(EnVar(self, var, envars_file['environment_variables'][var], self.app, desc=desc))
+            self.append(EnVar(self, var, envars_file['environment_variables'][var], self.app, desc=desc))
+
+    def configuration(self):
+        config = {}
+        if self.accounts is not None:
+            config['ACCOUNTS'] = self.accounts
+        config['APP'] = self.app
+        config['ENVIRONMENTS'] = self.envs
+        config['KMS_KEY_ARN'] = self.kms_key_arn
+        if self.data_keys is not None:
+            config['DATA_KEYS'] = self.data_keys
+        return config
+
+    def dump_configuration(self):
+        return SPACING.sub(r'\n\n  \1', dump({'configuration': self.configuration()}))
+
+    def dump_variables(self, variables):
+        return SPACING.sub(r'\n\n  \1', dump({'environment_variables': variables}))
 
     def save(self):
-        with open(self.filename, "w") as envars_yml:
-            data = {}
-            data['configuration'] = {}
-            data['configuration']['APP'] = self.app
-            data['configuration']['ENVIRONMENTS'] = self.envs
-            data['configuration']['KMS_KEY_ARN'] = self.kms_key_arn
-            stream = yaml.dump(data, default_flow_style=False)
-            envars_yml.write(re.sub(r'\n  ([A-Z])', r'\n\n  \1', stream))
-            envars_yml.write('\n')
-            data = {}
-            data['environment_variables'] = self.build_yaml()
-            stream = yaml.dump(data, default_flow_style=False)
-            envars_yml.write(re.sub(r'\n  ([A-Z])', r'\n\n  \1', stream))
+        """
+        Atomically write the file. When it was loaded (or saved) before, only
+        the variables changed since are patched into that text, so untouched
+        variables and comments are kept byte for byte.
+        """
+        from .files import atomic_write
+        text = self.patch() if self.source is not None else None
+        if text is None:
+            text = self.dump_configuration() + '\n' + self.dump_variables(self.build_yaml())
+        atomic_write(self.filename, text)
+        self.track(text)
+
+    def patch(self):
+        """The source text with the changes since it was loaded spliced in, None if it must be rewritten"""
+        from .splice import splice
+        source = self.source.decode('utf-8') if isinstance(self.source, bytes) else self.source
+        config = None
+        if self.configuration() != self._source_config:
+            config = self.dump_configuration()
+        variables = {}
+        for name in sorted(self.dirty):
+            var = self.index.get(name)
+            # the variable as save would write it, without the environment_variables line
+            variables[name] = self.dump_variables({name: var.envs}).split('\n', 2)[2] if var else None
+        if config is None and not variables:
+            return source
+        return splice(source, config, variables, self._source_count)
 
     def add(self, name, value, env_name='default', account=None, desc=None, is_secret=False):
         logging.debug(f'add({name}, {value}, {desc})')
 
-        if env_name != 'default':
-            if env_name not in self.envs:
-                raise (Exception(f'Unknown Env: "{env_name}"'))
-
-        if account and account not in ['master', 'sandbox']:
-            raise (Exception(f'Unknown Account: {account}'))
+        self.check(env_name, account)
+        self.changed(name)
 
         if is_secret:
-            from .kms import KMSAgent
-            kms_agent = KMSAgent(self.kms_key_arn)
-            encryption_context = {}
-            encryption_context['app'] = self.app
-            if env_name != 'default':
-                encryption_context['env'] = env_name
-            if account:
-                encryption_context['account'] = account
-            logging.debug(f'encryption_context({encryption_context})')
-            value = Secret(kms_agent.encrypt(value, encryption_context))
+            context = encryption_context(self.app, env_name, account)
+            logging.debug(f'encryption_context({context})')
+            value = self.encrypt_secret(value, context)
 
+        var = self.index.get(name)
         if account:
             logging.debug('createing account var')
-            for var in self.envars:
-                if var.name == name:
-                    if env_name not in var.envs:
-                        var.envs[env_name] = {}
-                    if isinstance(var.envs[env_name], str):
-                        var.envs[env_name] = {}
-                    var.envs[env_name][account] = value
-                    if desc:
-                        var.envs['description'] = desc
-                    return
-
-            self.envars.append(EnVar(
+            if var:
+                if env_name not in var.envs:
+                    var.envs[env_name] = {}
+                if isinstance(var.envs[env_name], str):
+                    var.envs[env_name] = {}
+                var.envs[env_name][account] = value
+                if desc:
+                    var.envs['description'] = desc
+                return
+
+            self.append(EnVar(
                 self,
                 name,
                 {env_name: {account: value}},
@@ -186,14 +421,13 @@ class EnVars:
             ))
         else:
             logging.debug('createing env var')
-            for var in self.envars:
-                if var.name == name:
-                    var.envs[env_name] = value
-                    if desc:
-                        var.envs['description'] = desc
-                    return
-
-            self.envars.append(EnVar(
+            if var:
+                var.envs[env_name] = value
+                if desc:
+                    var.envs['description'] = desc
+                return
+
+            self.append(EnVar(
                 self,
                 name,
                 {env_name: value},
@@ -201,6 +435,101 @@ class EnVars:
                 desc=desc,
             ))
 
+    def add_many(self, entries):
+        """
+        Add (name, value, env_name, account, desc, is_secret) entries,
+        encrypting all the secrets concurrently before adding them.
+        """
+        for _, _, env_name, account, _, _ in entries:
+            self.check(env_name, account)
+
+        values = [entry[1] for entry in entries]
+        secrets = [i for i, entry in enumerate(entries) if entry[5]]
+        ciphertexts = self.encrypt_secrets(
+            [(values[i], encryption_context(self.app, entries[i][2], entries[i][3])) for i in secrets]
+        )
+        for i, ciphertext in zip(secrets, ciphertexts):
+            values[i] = ciphertext
+
+        for (name, _, env_name, account, desc, _), value in zip(entries, values):
+            self.add(name, value, env_name, account=account, desc=desc)
+
+    def check(self, env_name, account):
+        if env_name != 'default':
+            if env_name not in self.envs:
+                raise (Exception(f'Unknown Env: "{env_name}"'))
+
+        if account and account not in self.account_names():
+            raise (Exception(f'Unknown Account: {account}'))
+
+    def append(self, var):
+        if var.name in self.index:
+            raise (Exception(f'Duplicate Var: "{var.name}"'))
+        self.envars.append(var)
+        self.index[var.name] = var
+
+    def remove(self, name):
+        var = self.index.pop(name, None)
+        if var is None:
+            raise (Exception(f'Unknown Var: "{name}"'))
+        self.envars.remove(var)
+        self.changed(name)
+        return var
+
+    def changed(self, name):
+        """Mark name as changed, dropping the table layouts built from the old values"""
+        self.layouts = {}
+        self.dirty.add(name)
+
+    def encrypt_secret(self, plaintext, encryption_context):
+        if self.envelope:
+            return Secret(self.envelope.encrypt(plaintext, encryption_context))
+        return Secret(self.kms_agent.encrypt(plaintext, encryption_context))
+
+    def encrypt_secrets(self, items):
+        """Encrypt (plaintext, encryption_context) pairs, returning Secrets in order"""
+        if self.envelope:
+            return [Secret(self.envelope.encrypt(plaintext, context)) for plaintext, context in items]
+        return [Secret(ciphertext) for ciphertext in self.kms_agent.encrypt_many(items)]
+
+    def decrypt_secrets(self, items):
+        """Decrypt (Secret, encryption_context) pairs, returning plaintexts in order"""
+        from .envelope import is_envelope
+        envelope_items = [(i, item) for i, item in enumerate(items) if is_envelope(item[0].value)]
+        kms_items = [(i, item) for i, item in enumerate(items) if not is_envelope(item[0].value)]
+
+        plaintexts = [None] * len(items)
+        if envelope_items:
+            if self.envelope is None:
+                raise (Exception('Envelope encrypted secret found but no DATA_KEYS configured'))
+            self.envelope.unwrap([context for _, (_, context) in envelope_items])
+            for i, (secret, context) in envelope_items:
+                with resource('decrypt', [secret_key(secret.value, context)]):
+                    plaintexts[i] = self.envelope.decrypt(secret.value, context)
+
+        values = self.kms_agent.decrypt_many([(secret.value, context) for _, (secret, context) in kms_items])
+        for (i, _), value in zip(kms_items, values):
+            plaintexts[i] = value
+        return plaintexts
+
+    def migrate_envelope(self):
+        """Re-encrypt every KMS secret under per-context envelope data keys"""
+        from .envelope import is_envelope
+        if self.data_keys is None:
+            self.data_keys = {}
+        secrets = []
+        for var in self.envars:
+            for env_name, account_name, value in var.items():
+                if isinstance(value, Secret) and not is_envelope(value.value):
+                    secrets.append((var, env_name, account_name, value))
+
+        plaintexts = self.decrypt_secrets(
+            [(value, var.encryption_context(env_name, account_name)) for var, env_name, account_name, value in secrets]
+        )
+        for (var, env_name, account_name, _), plaintext in zip(secrets, plaintexts):
+            var.set(env_name, account_name, self.encrypt_secret(plaintext, var.encryption_context(env_name, account_name)))
+        return len(secrets)
+
     def build_yaml(self, decrypt=False):
         envars = {}
         for var in self.envars:
@@ -208,47 +537,163 @@ class EnVars:
         return envars
 
     def get_var(self, var, env, account):
-        for v in self.envars:
-            if v.name == var:
-                return {v.name: v.get_value(env, account, fetch_pstore=True)}
+        v = self.index.get(var)
+        if v:
+            return {v.name: v.get_value(env, account, fetch_pstore=True)}
+
+    def precompile(self):
+        return precompile(self)
+
+    def table(self, env, account):
+        """
+        The (name, kind, value, env, account, pname) rows for the values that
+        apply to env/account, computed once per load (or read from a snapshot)
+        """
+        rows = self.layouts.get((env, account))
+        if isinstance(rows, bytes):
+            from .snapshot import unpack_table
+            rows = self.layouts[(env, account)] = unpack_table(rows)
+        if rows is not None:
+            return rows
+
+        rows = []
+        # profiling times each variable's lookup, checked once rather than per variable
+        profiled = profile() is not None
+        for var in self.envars:
+            if profiled:
+                with cost(var.name, 'lookup'):
+                    row = self._row(var, env, account)
+            else:
+                row = self._row(var, env, account)
+            if row:
+                rows.append(row)
+        self.layouts[(env, account)] = rows
+        return rows
+
+    def _row(self, var, env, account):
+        from .resolver import classify
+        value, env_name, account_name = var.lookup(env, account)
+        if not value:
+            return None
+        kind, pname = classify(value, env)
+        return (var.name, kind, value, env_name, account_name, pname)
+
+    def tables(self, accounts=None):
+        if accounts is None:
+            accounts = [None] + self.account_names()
+        return {(env, account): self.table(env, account) for env in self.envs for account in accounts}
+
+    def account_scoped(self, env, names):
+        """Whether names, or the variables their templates use, have account specific values in env"""
+        from .templates import is_template, references
+        seen = set()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            var = self.index.get(name)
+            if name in seen or var is None:
+                continue
+            seen.add(name)
+            for env_name in [env, 'default']:
+                value = var.envs.get(env_name)
+                if isinstance(value, dict):
+                    return True
+                if is_template(value):
+                    stack.extend(references(value))
+        return False
+
+    def plan(self, env, account):
+        from .resolver import Plan
+        return Plan.from_layout(self, env, account, self.table(env, account))
 
     def build_env(self, env, account, decrypt=False, template_vars=None):
         logging.debug(f'build_env({env}, {account})')
-        envars = {}
-
-        # fetch all the non secret values
-        for v in self.envars:
-            value = v.get_value(env, account, fetch_pstore=True)
-            if value and not isinstance(value, Secret):
-                if v.name not in template_vars.keys():
-                    template_vars[v.name] = value
-                envars[v.name] = value
-
-        jenv = jinja2.Environment()
+        envars = self.plan(env, account).execute(self, decrypt=decrypt, template_vars=template_vars)
+        if self._kms_agent:
+            self._kms_agent.flush()
+        return envars
 
-        # process jinja templates
-        for var in envars:
-            envars[var] = jenv.from_string(envars[var]).render(template_vars)
+    def resolve(self, env, account, names, decrypt=False, template_vars=None):
+        """Resolve only names and the variables their templates depend on"""
+        logging.debug(f'resolve({env}, {account}, {names})')
+        for name in names:
+            if name not in self.index:
+                raise (Exception(f'Unknown Var: "{name}"'))
+        envars = self.plan(env, account).execute(self, decrypt=decrypt, template_vars=template_vars, names=names)
+        if self._kms_agent:
+            self._kms_agent.flush()
+        return envars
 
-        # fetch secrets
-        for v in self.envars:
-            value = v.get_value(env, account, decrypt)
-            if value:
-                if v.name not in envars:
-                    envars[v.name] = value
+    def build_all(self, envs=None, accounts=None, decrypt=False, template_vars=None):
+        """
+        Resolve every env/account combination at once, returning
+        {(env, account): values}. STAGE is set to each env in template_vars.
+        """
+        from .resolver import execute_many
+        envs = self.envs if envs is None else envs
+        accounts = self.account_names() if accounts is None else accounts
+        logging.debug(f'build_all({envs}, {accounts})')
+        for env in envs:
+            self.check(env, None)
+        for account in accounts:
+            self.check('default', account)
+
+        plans = [self.plan(env, account) for env in envs for account in accounts]
+        envars = execute_many(
+            self,
+            plans,
+            decrypt=decrypt,
+            template_vars={(plan.env, plan.account): dict(template_vars or {}, STAGE=plan.env) for plan in plans},
+        )
+        if self._kms_agent:
+            self._kms_agent.flush()
+        return envars
 
+    async def abuild_env(self, env, account, decrypt=False, template_vars=None, concurrency=None):
+        """build_env for asyncio, with at most concurrency KMS/SSM calls in flight"""
+        logging.debug(f'abuild_env({env}, {account})')
+        return await self._aexecute(env, account, None, decrypt, template_vars, concurrency)
+
+    async def aresolve(self, env, account, names, decrypt=False, template_vars=None, concurrency=None):
+        """resolve for asyncio, with at most concurrency KMS/SSM calls in flight"""
+        logging.debug(f'aresolve({env}, {account}, {names})')
+        for name in names:
+            if name not in self.index:
+                raise (Exception(f'Unknown Var: "{name}"'))
+        return await self._aexecute(env, account, names, decrypt, template_vars, concurrency)
+
+    async def _aexecute(self, env, account, names, decrypt, template_vars, concurrency):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from .kms import DEFAULT_CONCURRENCY
+        if decrypt:
+            # created here rather than racing to create it in executor threads
+            self.kms_agent
+        executor = ThreadPoolExecutor(max_workers=concurrency or self.kms_concurrency or DEFAULT_CONCURRENCY)
+        try:
+            envars = await self.plan(env, account).aexecute(
+                self,
+                decrypt=decrypt,
+                template_vars=template_vars,
+                names=names,
+                executor=executor,
+            )
+        finally:
+            executor.shutdown(wait=False)
+        if self._kms_agent:
+            self._kms_agent.flush()
         return envars
 
     def build(self, account, var=None, decrypt=False):
         logging.debug(f'build({account}, {var}, {decrypt})')
+        if isinstance(var, str):
+            var = [var]
         envars = {}
-        for v in self.envars:
-            if var and v.name != var:
-                continue
+        for v in ([self.index[name] for name in var if name in self.index] if var else self.envars):
             envars[v.name] = v.envs
 
         return envars
 
     def print(self, account, env=None, var=None, decrypt=False):
         logging.debug(f'print({account}, {env}, {decrypt})')
-        return yaml.dump(self.build(account, var, decrypt))
+        return dump(self.build(account, var, decrypt))
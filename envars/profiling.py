@@ -0,0 +1,146 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+
+KINDS = ['lookup', 'decrypt', 'pstore', 'render']
+REPORT_TOP = 20
+
+_profile = None
+
+
+class VariableProfile(object):
+    """
+    Time spent on each variable. Decrypts and parameter store fetches are
+    timed per ciphertext/parameter and attributed to the variables that use
+    them, split evenly when several share one.
+    """
+
+    def __init__(self):
+        self.costs = {}
+        self.resources = {}
+        self.owners = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, kind, seconds):
+        with self._lock:
+            costs = self.costs.setdefault(name, dict.fromkeys(KINDS, 0.0))
+            costs[kind] += seconds
+
+    def add_resource(self, kind, key, seconds):
+        with self._lock:
+            self.resources[(kind, key)] = self.resources.get((kind, key), 0.0) + seconds
+
+    def own(self, kind, key, name):
+        with self._lock:
+            self.owners.setdefault((kind, key), set()).add(name)
+
+    def report(self):
+        """Rows of {name, lookup, decrypt, pstore, render, total}, most expensive first"""
+        costs = {name: dict(kinds) for name, kinds in self.costs.items()}
+        for (kind, key), seconds in self.resources.items():
+            names = self.owners.get((kind, key))
+            if not names:
+                continue
+            for name in names:
+                costs.setdefault(name, dict.fromkeys(KINDS, 0.0))[kind] += seconds / len(names)
+        rows = [dict(kinds, name=name, total=sum(kinds.values())) for name, kinds in costs.items()]
+        return sorted(rows, key=lambda row: (-row['total'], row['name']))
+
+
+def enable():
+    global _profile
+    _profile = VariableProfile()
+    return _profile
+
+
+def disable():
+    global _profile
+    _profile = None
+
+
+def profile():
+    return _profile
+
+
+@contextlib.contextmanager
+def cost(name, kind):
+    """Time the enclosed block against variable name, a no-op unless profiling is enabled"""
+    if _profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profile.add(name, kind, time.perf_counter() - started)
+
+
+@contextlib.contextmanager
+def resource(kind, keys):
+    """Time the enclosed fetch of keys (parameter names or secret keys), split between them"""
+    if _profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) / max(len(keys), 1)
+        for key in keys:
+            _profile.add_resource(kind, key, elapsed)
+
+
+def secret_key(ciphertext, encryption_context):
+    return (ciphertext, tuple(sorted(encryption_context.items())))
+
+
+def attribute(entries):
+    """Record which variables use the parameters and secrets of plan entries"""
+    if _profile is None:
+        return
+    from .resolver import PSTORE, SECRET
+    for entry in entries:
+        if entry.kind == PSTORE:
+            _profile.own('pstore', entry.pname, entry.name)
+        elif entry.kind == SECRET:
+            _profile.own('decrypt', secret_key(entry.value.value, entry.context), entry.name)
+
+
+def format_text(rows, top=REPORT_TOP):
+    lines = [f'{"variable":<32} {"total":>9} ' + ' '.join(f'{kind:>9}' for kind in KINDS)]
+    for row in rows[:top]:
+        lines.append(f'{row["name"]:<32} {row["total"]:>9.4f} ' + ' '.join(f'{row[kind]:>9.4f}' for kind in KINDS))
+    if len(rows) > top:
+        lines.append(f'... {len(rows) - top} more')
+    return '\n'.join(lines) + '\n'
+
+
+class Profiler(object):
+    """cProfile of a whole command plus the per-variable report, written to path"""
+
+    def __init__(self, path):
+        import cProfile
+        self.path = path
+        self.profiler = cProfile.Profile()
+        self.written = False
+
+    def start(self):
+        enable()
+        self.profiler.enable()
+
+    def write(self):
+        if self.written:
+            return
+        self.written = True
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        rows = _profile.report() if _profile else []
+        with open(f'{self.path}.variables.json', 'w') as f:
+            json.dump(rows, f, indent=2)
+            f.write('\n')
+        sys.stderr.write(format_text(rows))
+        sys.stderr.write(f'profile written to {self.path}, per-variable costs to {self.path}.variables.json\n')
+        sys.stderr.flush()
+        disable()
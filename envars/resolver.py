@@ -0,0 +1,352 @@
+import logging
+
+from .models import Secret, encryption_context, pstore_name
+from .profiling import attribute, cost
+from .templates import is_template, references, render
+from .timings import phase
+
+LITERAL = 'literal'
+TEMPLATE = 'template'
+PSTORE = 'pstore'
+SECRET = 'secret'
+
+
+class PlanEntry(object):
+    __slots__ = ('name', 'kind', 'value', 'env', 'account', 'pname', 'context')
+
+    def __init__(self, name, kind, value, env=None, account=None, pname=None, context=None):
+        self.name = name
+        self.kind = kind
+        self.value = value
+        self.env = env
+        self.account = account
+        self.pname = pname
+        self.context = context
+
+    def __repr__(self):
+        return f"PlanEntry(name='{self.name}', kind='{self.kind}')"
+
+
+def classify(value, env):
+    if isinstance(value, Secret):
+        return SECRET, None
+    pname = pstore_name(value, env)
+    if pname:
+        return PSTORE, pname
+    if is_template(value):
+        return TEMPLATE, None
+    return LITERAL, None
+
+
+class Plan(object):
+    """
+    The values that apply to one env/account, classified in a single walk of
+    the variables so they can be resolved in batched stages.
+    """
+
+    def __init__(self, env, account, entries):
+        self.env = env
+        self.account = account
+        self.entries = entries
+
+    @classmethod
+    def from_layout(cls, envars, env, account, layout):
+        """Build a plan from precomputed (name, kind, value, env, account, pname) rows"""
+        entries = []
+        for name, kind, value, env_name, account_name, pname in layout:
+            context = encryption_context(envars.app, env_name, account_name) if kind == SECRET else None
+            entries.append(PlanEntry(name, kind, value, env_name, account_name, pname, context))
+        return cls(env, account, entries)
+
+    def check(self):
+        """Raise if the templates in this plan have a dependency cycle"""
+        entries = {entry.name: entry for entry in self.entries}
+        self._sort(list(entries), entries, {}, {})
+
+    def select(self, names=None, template_vars=None):
+        """The entries for names and the variables their templates depend on, all entries if names is None"""
+        if names is None:
+            return self.entries
+        entries = {entry.name: entry for entry in self.entries}
+        selected = set(self._closure([name for name in names if name in entries], entries, template_vars or {}, {}))
+        return [entry for entry in self.entries if entry.name in selected]
+
+    def pstore_names(self, entries=None):
+        return [entry.pname for entry in (self.entries if entries is None else entries) if entry.kind == PSTORE]
+
+    def secrets(self, entries=None):
+        return [entry for entry in (self.entries if entries is None else entries) if entry.kind == SECRET]
+
+    def execute(self, envars, decrypt=False, template_vars=None, names=None):
+        """
+        Resolve the plan, or only names and the variables their templates
+        depend on, rendering each template once in dependency order.
+        """
+        logging.debug(f'execute plan({self.env}, {self.account}, {len(self.entries)} entries)')
+        selected, values = self.fetch(envars, decrypt=decrypt, template_vars=template_vars, names=names)
+        return self.render(selected, values, decrypt=decrypt, template_vars=template_vars, names=names)
+
+    def fetch(self, envars, decrypt=False, template_vars=None, names=None, pstore=None):
+        """
+        The unrendered values of the plan, or of names and the variables their
+        templates depend on, as (selected names, values). Parameter store
+        values already in pstore (by parameter name) are not fetched again.
+        """
+        template_vars = dict(template_vars or {})
+        entries = {entry.name: entry for entry in self.entries}
+        values = {}
+
+        if names is None:
+            selected = list(entries)
+            self._fetch(envars, self.entries, decrypt, values, pstore)
+        else:
+            # pstore values may themselves be templates, so the subgraph can
+            # only grow once they have been fetched
+            selected = []
+            while True:
+                expanded = self._closure([name for name in names if name in entries], entries, template_vars, values)
+                if set(expanded) == set(selected):
+                    break
+                selected = expanded
+                self._fetch(envars, [entries[name] for name in selected if name not in values], decrypt, values, pstore)
+        return selected, values
+
+    def render(self, selected, values, decrypt=False, template_vars=None, names=None):
+        """Render unrendered values from fetch(), which are left as they were"""
+        entries = {entry.name: entry for entry in self.entries}
+        return self._render(selected, entries, dict(template_vars or {}), dict(values), decrypt, names)
+
+    def update_pstore(self, values, pstore):
+        """Replace the parameter store values in unrendered values with those in pstore, returning the names changed"""
+        changed = []
+        for entry in self.entries:
+            if entry.kind == PSTORE and entry.name in values and entry.pname in pstore and values[entry.name] != pstore[entry.pname]:
+                values[entry.name] = pstore[entry.pname]
+                changed.append(entry.name)
+        return changed
+
+    async def aexecute(self, envars, decrypt=False, template_vars=None, names=None, executor=None):
+        """
+        execute() for asyncio, running the parameter store and KMS calls
+        concurrently in executor.
+        """
+        logging.debug(f'aexecute plan({self.env}, {self.account}, {len(self.entries)} entries)')
+        template_vars = dict(template_vars or {})
+        entries = {entry.name: entry for entry in self.entries}
+        values = {}
+
+        if names is None:
+            selected = list(entries)
+            await self._afetch(envars, self.entries, decrypt, values, executor)
+        else:
+            selected = []
+            while True:
+                expanded = self._closure([name for name in names if name in entries], entries, template_vars, values)
+                if set(expanded) == set(selected):
+                    break
+                selected = expanded
+                await self._afetch(envars, [entries[name] for name in selected if name not in values], decrypt, values, executor)
+
+        return self._render(selected, entries, template_vars, values, decrypt, names)
+
+    def _render(self, selected, entries, template_vars, values, decrypt, names):
+        with phase('render'):
+            return self._render_values(selected, entries, template_vars, values, decrypt, names)
+
+    def _render_values(self, selected, entries, template_vars, values, decrypt, names):
+        order = self._sort(selected, entries, template_vars, values)
+
+        # values not overridden by template_vars are available to templates,
+        # a variable referencing itself sees its own unrendered value
+        context = dict(template_vars)
+        for name in selected:
+            if name not in template_vars and values.get(name):
+                if entries[name].kind != SECRET or decrypt:
+                    context[name] = values[name]
+
+        for name in order:
+            if entries[name].kind != SECRET and values.get(name):
+                with cost(name, 'render'):
+                    values[name] = render(values[name], context)
+                if name not in template_vars:
+                    context[name] = values[name]
+
+        selected = set(selected if names is None else names)
+        result = {}
+        for entry in self.entries:
+            if entry.kind != SECRET and entry.name in selected and values.get(entry.name):
+                result[entry.name] = values[entry.name]
+        for entry in self.secrets():
+            if entry.name in selected:
+                result[entry.name] = values[entry.name]
+        return result
+
+    def _fetch(self, envars, entries, decrypt, values, pstore=None):
+        attribute(entries)
+        # parameter store references, fetched in batches
+        fetched = dict(pstore or {})
+        pnames = [pname for pname in self.pstore_names(entries) if pname not in fetched]
+        if pnames:
+            from .ssm import SsmAgent
+            ssm_agent = SsmAgent(by_path_threshold=envars.pstore_by_path_threshold)
+            with phase('pstore fetch'):
+                fetched.update(ssm_agent.fetch_many(pnames))
+            logging.debug(f'ssm single-flight {SsmAgent.flight.stats()}')
+
+        # secrets, decrypted concurrently
+        secrets = self.secrets(entries)
+        if decrypt:
+            with phase('decrypt'):
+                plaintexts = envars.decrypt_secrets([(entry.value, entry.context) for entry in secrets])
+        else:
+            plaintexts = [entry.value for entry in secrets]
+        for entry, value in zip(secrets, plaintexts):
+            values[entry.name] = value
+
+        for entry in entries:
+            if entry.kind == PSTORE:
+                values[entry.name] = fetched[entry.pname]
+            elif entry.kind != SECRET:
+                values[entry.name] = entry.value
+
+    async def _afetch(self, envars, entries, decrypt, values, executor):
+        attribute(entries)
+        import asyncio
+
+        from .envelope import is_envelope
+        from .ssm import GET_PARAMETERS_MAX, SsmAgent
+        loop = asyncio.get_running_loop()
+
+        # one call per GetParameters batch, unless batches are built by path
+        ssm_calls = []
+        pnames = list(dict.fromkeys(self.pstore_names(entries)))
+        if pnames:
+            ssm_agent = SsmAgent(by_path_threshold=envars.pstore_by_path_threshold)
+            step = len(pnames) if envars.pstore_by_path_threshold else GET_PARAMETERS_MAX
+            for i in range(0, len(pnames), step):
+                ssm_calls.append(loop.run_in_executor(executor, ssm_agent.fetch_many, pnames[i:i + step]))
+
+        # one call per KMS secret, envelope secrets share data keys so are decrypted together
+        secrets = self.secrets(entries)
+        batches = []
+        if decrypt:
+            batches = [[entry] for entry in secrets if not is_envelope(entry.value.value)]
+            envelope = [entry for entry in secrets if is_envelope(entry.value.value)]
+            if envelope:
+                batches.append(envelope)
+        secret_calls = [
+            loop.run_in_executor(executor, envars.decrypt_secrets, [(entry.value, entry.context) for entry in batch])
+            for batch in batches
+        ]
+
+        with phase('pstore fetch and decrypt'):
+            results = await asyncio.gather(*ssm_calls, *secret_calls)
+        fetched = {}
+        for result in results[:len(ssm_calls)]:
+            fetched.update(result)
+        for batch, plaintexts in zip(batches, results[len(ssm_calls):]):
+            for entry, value in zip(batch, plaintexts):
+                values[entry.name] = value
+
+        for entry in entries:
+            if entry.kind == PSTORE:
+                values[entry.name] = fetched[entry.pname]
+            elif entry.kind == SECRET:
+                if not decrypt:
+                    values[entry.name] = entry.value
+            else:
+                values[entry.name] = entry.value
+
+    def _dependencies(self, name, entries, template_vars, values):
+        value = values.get(name, entries[name].value)
+        if entries[name].kind == SECRET or not is_template(value):
+            return []
+        return [ref for ref in sorted(references(value)) if ref in entries and ref not in template_vars and ref != name]
+
+    def _closure(self, names, entries, template_vars, values):
+        selected = {}
+        stack = list(reversed(names))
+        while stack:
+            name = stack.pop()
+            if name in selected:
+                continue
+            selected[name] = True
+            stack.extend(self._dependencies(name, entries, template_vars, values))
+        return list(selected)
+
+    def _sort(self, names, entries, template_vars, values):
+        order = []
+        state = {}
+        for root in names:
+            if root in state:
+                continue
+            path = [root]
+            stack = [iter(self._dependencies(root, entries, template_vars, values))]
+            state[root] = 'visiting'
+            while stack:
+                for dep in stack[-1]:
+                    if state.get(dep) == 'visiting':
+                        cycle = path[path.index(dep):] + [dep]
+                        raise (Exception(f'Template cycle detected: {" -> ".join(cycle)}'))
+                    if dep not in state:
+                        state[dep] = 'visiting'
+                        path.append(dep)
+                        stack.append(iter(self._dependencies(dep, entries, template_vars, values)))
+                        break
+                else:
+                    stack.pop()
+                    state[path[-1]] = 'done'
+                    order.append(path.pop())
+        return order
+
+
+def execute_many(envars, plans, decrypt=False, template_vars=None):
+    """
+    Resolve several plans, fetching each parameter store name and decrypting
+    each ciphertext/context pair once across all of them. template_vars maps
+    (env, account) to the template variables of that plan.
+    """
+    template_vars = template_vars or {}
+    for plan in plans:
+        attribute(plan.entries)
+    pnames = list(dict.fromkeys(pname for plan in plans for pname in plan.pstore_names()))
+    fetched = {}
+    if pnames:
+        from .ssm import SsmAgent
+        with phase('pstore fetch'):
+            fetched = SsmAgent(by_path_threshold=envars.pstore_by_path_threshold).fetch_many(pnames)
+
+    secrets = {}
+    for plan in plans:
+        for entry in plan.secrets():
+            secrets.setdefault(secret_key(entry), (entry.value, entry.context))
+    plaintexts = {}
+    if decrypt:
+        with phase('decrypt'):
+            plaintexts = dict(zip(secrets, envars.decrypt_secrets(list(secrets.values()))))
+    logging.debug(f'execute_many({len(plans)} plans, {len(pnames)} parameters, {len(secrets)} secrets)')
+
+    results = {}
+    for plan in plans:
+        values = {}
+        for entry in plan.entries:
+            if entry.kind == PSTORE:
+                values[entry.name] = fetched[entry.pname]
+            elif entry.kind == SECRET:
+                values[entry.name] = plaintexts[secret_key(entry)] if decrypt else entry.value
+            else:
+                values[entry.name] = entry.value
+        entries = {entry.name: entry for entry in plan.entries}
+        results[(plan.env, plan.account)] = plan._render(
+            list(entries),
+            entries,
+            dict(template_vars.get((plan.env, plan.account)) or {}),
+            values,
+            decrypt,
+            None,
+        )
+    return results
+
+
+def secret_key(entry):
+    return (entry.value.value, tuple(sorted(entry.context.items())))
@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key, callers asking for a key already in flight wait
+    for and share its result. With memoize, completed results are kept and
+    returned to later callers too.
+    """
+
+    def __init__(self, memoize=True):
+        self.memoize = memoize
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+        self._results = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, method, *args, **kwargs):
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                return self._results[key]
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                self.misses += 1
+                call = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not owner:
+            return call.result()
+
+        try:
+            result = method(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.set_exception(e)
+            raise
+        with self._lock:
+            if self.memoize:
+                self._results[key] = result
+            del self._calls[key]
+        call.set_result(result)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._results = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'shared': self.shared, 'misses': self.misses}
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import marshal
+import os
+import sys
+
+from .files import atomic_write
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_SUFFIX = '.snapshot'
+SECRET_TAG = '!secret'
+
+
+def snapshot_path(filename):
+    return f'{filename}{SNAPSHOT_SUFFIX}'
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def encode(value):
+    # marshal only handles builtin types, secrets become ('!secret', value)
+    from .models import Secret
+    if isinstance(value, Secret):
+        return (SECRET_TAG, value.value)
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    return value
+
+
+def decode(value):
+    from .models import Secret
+    if isinstance(value, tuple) and len(value) == 2 and value[0] == SECRET_TAG:
+        return Secret(value[1])
+    if isinstance(value, dict):
+        return {k: decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+
+def compile_snapshot(envars, content, path=None):
+    """
+    Write a marshal snapshot of a loaded envars file, keyed by the hash of
+    its YAML content, holding the parsed variables, the resolved layout of
+    every env/account and the names each template refers to. The variables
+    and each layout are marshalled separately so loading only unpacks the
+    ones that are used.
+    """
+    from .models import PSTORE_PREFIX
+    from .templates import is_template, references
+
+    layouts = {}
+    for key, table in envars.tables().items():
+        layouts[key] = marshal.dumps([
+            (name, kind, encode(value), env_name, account_name, pname)
+            for name, kind, value, env_name, account_name, pname in table
+        ])
+
+    templates = {}
+    for var in envars.envars:
+        for _, _, value in var.items():
+            if is_template(value) and PSTORE_PREFIX not in value:
+                templates[value] = sorted(references(value))
+
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'python': tuple(sys.version_info[:2]),
+        'hash': content_hash(content),
+        'configuration': encode({
+            'APP': envars.app,
+            'KMS_KEY_ARN': envars.kms_key_arn,
+            'ENVIRONMENTS': envars.envs,
+            'DATA_KEYS': envars.data_keys,
+            'ACCOUNTS': envars.accounts,
+        }),
+        'count': len(envars.envars),
+        'variables': marshal.dumps([(var.name, encode(var.envs)) for var in envars.envars]),
+        'layouts': layouts,
+        'templates': templates,
+    }
+    path = path or snapshot_path(envars.filename)
+    atomic_write(path, marshal.dumps(data))
+    return path
+
+
+def load_snapshot(envars, content, path=None):
+    """Populate envars from its snapshot if it matches content, returning True when it was used"""
+    path = path or snapshot_path(envars.filename)
+    if not os.path.exists(path):
+        return False
+
+    try:
+        with open(path, 'rb') as f:
+            data = marshal.load(f)
+    except Exception as e:
+        logging.debug(f'unreadable snapshot {path}: {e}')
+        return False
+
+    if (
+        not isinstance(data, dict) or
+        data.get('version') != SNAPSHOT_VERSION or
+        data.get('python') != tuple(sys.version_info[:2]) or
+        data.get('hash') != content_hash(content)
+    ):
+        logging.debug(f'stale snapshot {path}')
+        return False
+
+    from .templates import prime_references
+
+    config = decode(data['configuration'])
+    envars.app = config['APP']
+    envars.kms_key_arn = config['KMS_KEY_ARN']
+    envars.envs = config['ENVIRONMENTS']
+    envars.data_keys = config['DATA_KEYS']
+    envars.accounts = config.get('ACCOUNTS')
+    # variables and layouts stay packed until EnVars first needs them
+    envars.pack(data['count'], data['variables'])
+    envars.layouts = dict(data['layouts'])
+    prime_references(data['templates'])
+    return True
+
+
+def unpack_variables(envars, packed):
+    from .models import EnVar
+    for name, envs in marshal.loads(packed):
+        envs = decode(envs)
+        envars.append(EnVar(envars, name, envs, envars.app, desc=envs.get('description')))
+
+
+def unpack_table(packed):
+    return [
+        (name, kind, decode(value), env_name, account_name, pname)
+        for name, kind, value, env_name, account_name, pname in marshal.loads(packed)
+    ]
@@ -0,0 +1,92 @@
+"""
+Edit the text of a saved envars.yml in place. Only the spans of the
+configuration block and of the variables that changed are replaced, every
+other byte (comments included) is kept as it was.
+"""
+import re
+
+TOP_KEY = re.compile(r'^([^\s#][^:\n]*):', re.M)
+VAR_KEY = re.compile(r'^  ([^\s#][^:\n]*):[ \t]*$', re.M)
+
+
+def content_end(text, start, end, indent):
+    """End of the last line in text[start:end], after the key line at start, indented deeper than indent"""
+    last = text.find('\n', start, end)
+    last = end if last == -1 else last + 1
+    for match in re.compile(rf'^[ ]{{{indent + 1},}}\S.*\n?', re.M).finditer(text, last, end):
+        last = match.end()
+    return last
+
+
+def blocks(text):
+    """Map of top level key to its (start, end) in text"""
+    matches = list(TOP_KEY.finditer(text))
+    ends = [match.start() for match in matches[1:]] + [len(text)]
+    return {match.group(1): (match.start(), end) for match, end in zip(matches, ends)}
+
+
+def splice(text, config=None, variables=None, count=None):
+    """
+    Return text with the configuration block replaced by config, when
+    given, and each name in variables replaced by its text, removed when
+    the text is None or inserted in sorted position when new.
+
+    None is returned when text isn't laid out the way EnVars.save writes it
+    or doesn't hold count variables, and has to be written in full.
+    """
+    variables = variables or {}
+    found = blocks(text)
+    if 'configuration' not in found or 'environment_variables' not in found:
+        return None
+
+    start, end = found['environment_variables']
+    keys = [(match.group(1), match.start()) for match in VAR_KEY.finditer(text, start, end)]
+    if not keys or (count is not None and len(keys) != count):
+        return None
+    names = [name for name, _ in keys]
+    positions = {name: i for i, name in enumerate(names)}
+    if len(positions) != len(names):
+        return None
+
+    edits = []
+    if config is not None:
+        config_start, config_end = found['configuration']
+        edits.append((config_start, content_end(text, config_start, config_end, 0), config))
+
+    remaining = len(names)
+    for name, value in variables.items():
+        i = positions.get(name)
+        if i is None:
+            if value is None:
+                continue
+            remaining += 1
+            after = next((j for j, existing in enumerate(names) if existing > name), None)
+            if after is not None:
+                edits.append((keys[after][1], keys[after][1], value + '\n'))
+            else:
+                last = content_end(text, keys[-1][1], end, 2)
+                edits.append((last, last, '\n' + value))
+            continue
+
+        var_start = keys[i][1]
+        var_end = content_end(text, var_start, keys[i + 1][1] if i + 1 < len(keys) else end, 2)
+        if value is None:
+            remaining -= 1
+            # take the blank line separating it from its neighbour with it
+            if text.startswith('\n', var_end):
+                var_end += 1
+            elif text[var_start - 2:var_start] == '\n\n':
+                var_start -= 1
+        edits.append((var_start, var_end, value or ''))
+
+    if remaining == 0:
+        return None
+
+    pieces = []
+    pos = 0
+    for edit_start, edit_end, value in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        pieces.append(text[pos:edit_start])
+        pieces.append(value)
+        pos = edit_end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
@@ -1,25 +1,110 @@
-import sys
+from botocore.exceptions import ClientError
 
-import boto3
-from botocore.exceptions import ClientError, NoCredentialsError, ProfileNotFound
+from .aws import get_client
+from .profiling import resource
+from .singleflight import SingleFlight
 
-try:
-    ssm_client = boto3.client('ssm')
-except (ProfileNotFound, NoCredentialsError):
-    print('AWS credentials not found, is AWS_PROFILE set? does "~/.aws/credentials" exist?')
-    sys.exit(1)
+GET_PARAMETERS_MAX = 10
+UNKNOWN_ERROR = 'UNKNOWN-ERROR-FETCHING-FROM-PARAMETER-STORE'
+
+
+class ParameterStoreError(Exception):
+    pass
 
 
 class SsmAgent(object):
+    # parameters can change, so only calls in flight are shared, not results
+    flight = SingleFlight(memoize=False)
+
+    def __init__(self, by_path_threshold=None, strict=False):
+        """
+        Unexpected errors (throttling, missing values) give UNKNOWN_ERROR
+        values, or with strict raise ParameterStoreError.
+        """
+        self.by_path_threshold = by_path_threshold
+        self.strict = strict
 
     def fetch(self, name):
-        value = 'UNKNOWN-ERROR-FETCHING-FROM-PARAMETER-STORE'
+        return self.flight.do((self.strict, name), self._fetch, name)
+
+    def _fetch(self, name):
+        value = None
         try:
-            param = ssm_client.get_parameter(Name=name, WithDecryption=True)
+            with resource('pstore', [name]):
+                param = get_client('ssm').get_parameter(Name=name, WithDecryption=True)
             value = param['Parameter']['Value']
         except ClientError as e:
             if e.response['Error']['Code'] == 'ParameterNotFound':
                 value = f'NOT-FOUND-IN-PSTORE-{name}'
             elif e.response['Error']['Code'] == 'AccessDeniedException':
                 value = f'PARAMETER-STORE-ACCESS-DENIED-{name}'
+            else:
+                return self._unknown([name], e)[name]
         return value
+
+    def fetch_many(self, names):
+        """Fetch parameter names in batches, returning a {name: value} dict"""
+        names = list(dict.fromkeys(names))
+        values = {}
+        if self.by_path_threshold:
+            values.update(self._fetch_by_path(names))
+
+        remaining = [name for name in names if name not in values]
+        for i in range(0, len(remaining), GET_PARAMETERS_MAX):
+            values.update(self._fetch_chunk(remaining[i:i + GET_PARAMETERS_MAX]))
+
+        return values
+
+    def _fetch_chunk(self, names):
+        if len(names) == 1:
+            return {names[0]: self.fetch(names[0])}
+        return self.flight.do((self.strict, tuple(names)), self._get_parameters, names)
+
+    def _get_parameters(self, names):
+        values = {}
+        try:
+            with resource('pstore', names):
+                response = get_client('ssm').get_parameters(Names=names, WithDecryption=True)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'AccessDeniedException':
+                # a single denied name fails the whole batch, fall back to
+                # fetching individually so only the denied names are flagged
+                return {name: self.fetch(name) for name in names}
+            return self._unknown(names, e)
+
+        for param in response['Parameters']:
+            values[param['Name']] = param['Value']
+        for name in response.get('InvalidParameters', []):
+            values[name] = f'NOT-FOUND-IN-PSTORE-{name}'
+        missing = [name for name in names if name not in values]
+        if missing:
+            values.update(self._unknown(missing, 'not in the GetParameters response'))
+        return values
+
+    def _unknown(self, names, error):
+        if self.strict:
+            raise (ParameterStoreError(f'unable to fetch {", ".join(names)}: {error}'))
+        return {name: UNKNOWN_ERROR for name in names}
+
+    def _fetch_by_path(self, names):
+        paths = {}
+        for name in names:
+            if '/' in name.strip('/'):
+                paths.setdefault(name.rsplit('/', 1)[0], []).append(name)
+
+        values = {}
+        for path, path_names in paths.items():
+            if len(path_names) < self.by_path_threshold:
+                continue
+            wanted = set(path_names)
+            try:
+                with resource('pstore', path_names):
+                    paginator = get_client('ssm').get_paginator('get_parameters_by_path')
+                    for page in paginator.paginate(Path=path, Recursive=False, WithDecryption=True):
+                        for param in page['Parameters']:
+                            if param['Name'] in wanted:
+                                values[param['Name']] = param['Value']
+            except ClientError:
+                # leave the names for GetParameters to resolve or flag
+                continue
+        return values
@@ -0,0 +1,49 @@
+import os
+import subprocess
+
+from .files import atomic_write
+
+# stay well under ARG_MAX, the caller's environment shares the same space
+ARGV_FALLBACK = 131072
+SHELL_NEED_ESCAPE = '\\"`$'
+
+
+def argv_limit():
+    try:
+        return os.sysconf('SC_ARG_MAX') // 2
+    except (ValueError, OSError, AttributeError):
+        return ARGV_FALLBACK
+
+
+def chunk_assignments(assignments, limit=None):
+    """Split NAME=value assignments into argv chunks below limit bytes"""
+    limit = limit or argv_limit()
+    chunk = []
+    size = 0
+    for assignment in assignments:
+        length = len(assignment.encode('utf-8')) + 1
+        if chunk and size + length > limit:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(assignment)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def set_environment(values, limit=None):
+    """Set values in the systemd manager environment with as few systemctl calls as argv allows"""
+    assignments = [f'{name}={value}' for name, value in values.items()]
+    for chunk in chunk_assignments(assignments, limit):
+        subprocess.run(['systemctl', 'set-environment'] + chunk, check=True)
+
+
+def quote(value):
+    return '"' + ''.join(f'\\{c}' if c in SHELL_NEED_ESCAPE else c for c in value) + '"'
+
+
+def write_environment_file(path, values):
+    """Atomically write values as a systemd EnvironmentFile, readable only by its owner"""
+    data = ''.join(f'{name}={quote(value)}\n' for name, value in values.items())
+    atomic_write(path, data, mode=0o600)
@@ -0,0 +1,60 @@
+import functools
+
+TEMPLATE_MARKERS = ('{{', '{%', '{#')
+CACHE_SIZE = 1024
+
+
+def is_template(value):
+    return isinstance(value, str) and any(marker in value for marker in TEMPLATE_MARKERS)
+
+
+@functools.lru_cache(maxsize=None)
+def environment():
+    import jinja2
+    return jinja2.Environment()
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile_template(source):
+    return environment().from_string(source)
+
+
+_references = {}
+
+
+def references(source):
+    """Return the names a template refers to"""
+    try:
+        return _references[source]
+    except KeyError:
+        pass
+    from jinja2 import meta
+    refs = frozenset(meta.find_undeclared_variables(environment().parse(source)))
+    _references[source] = refs
+    return refs
+
+
+def prime_references(refs):
+    """Seed the references cache, e.g. from a compiled snapshot"""
+    for source, names in refs.items():
+        _references[source] = frozenset(names)
+
+
+def render(value, context):
+    """Render value as a jinja template, values without template markers are returned as is"""
+    if not is_template(value):
+        return value
+    return compile_template(value).render(context)
+
+
+def precompile(envars):
+    """Compile every template in envars ahead of rendering, returning the number compiled"""
+    from .models import PSTORE_PREFIX
+    sources = set()
+    for var in envars.envars:
+        for _, _, value in var.items():
+            if is_template(value):
+                sources.add(value.split(':')[1] if PSTORE_PREFIX in value else value)
+    for source in sources:
+        compile_template(source)
+    return len(sources)
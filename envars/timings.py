@@ -0,0 +1,165 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# upper bounds of the AWS call latency histogram buckets, in milliseconds
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+THROTTLING_ERRORS = ['ThrottlingException', 'TooManyRequestsException', 'LimitExceededException', 'Throttling']
+
+_recorder = None
+
+
+class Recorder(object):
+    """Phase durations and AWS call statistics for one envars command"""
+
+    def __init__(self, command=None):
+        self.command = command
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.calls = {}
+        self.reported = False
+        self.clients = []
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+            phase['seconds'] += seconds
+            phase['count'] += 1
+
+    def _call(self, event_name):
+        # event names are "<event>.<service>.<Operation>"
+        _, service, operation = event_name.split('.', 2)
+        return self.calls.setdefault(f'{service}:{operation}', {
+            'calls': 0,
+            'attempts': 0,
+            'errors': {},
+            'throttled': 0,
+            'seconds': 0.0,
+            'histogram': [0] * (len(BUCKETS) + 1),
+        })
+
+    def before_call(self, context, **kwargs):
+        context['timings_started'] = time.perf_counter()
+
+    def before_send(self, event_name, **kwargs):
+        with self._lock:
+            self._call(event_name)['attempts'] += 1
+
+    def after_call(self, event_name, parsed, context, **kwargs):
+        self._finish(event_name, context, (parsed or {}).get('Error', {}).get('Code'))
+
+    def after_call_error(self, event_name, exception, context, **kwargs):
+        self._finish(event_name, context, type(exception).__name__)
+
+    def _finish(self, event_name, context, error):
+        elapsed = time.perf_counter() - context.get('timings_started', time.perf_counter())
+        milliseconds = elapsed * 1000
+        bucket = next((i for i, bound in enumerate(BUCKETS) if milliseconds <= bound), len(BUCKETS))
+        with self._lock:
+            call = self._call(event_name)
+            call['calls'] += 1
+            call['seconds'] += elapsed
+            call['histogram'][bucket] += 1
+            if error:
+                call['errors'][error] = call['errors'].get(error, 0) + 1
+                if error in THROTTLING_ERRORS:
+                    call['throttled'] += 1
+
+    def handlers(self):
+        return [
+            ('before-call', self.before_call),
+            ('before-send', self.before_send),
+            ('after-call', self.after_call),
+            ('after-call-error', self.after_call_error),
+        ]
+
+    def instrument(self, client):
+        for event, handler in self.handlers():
+            client.meta.events.register(event, handler)
+        self.clients.append(client)
+
+    def uninstrument(self):
+        for client in self.clients:
+            for event, handler in self.handlers():
+                client.meta.events.unregister(event, handler)
+        self.clients = []
+
+    def report(self):
+        calls = {}
+        for name, call in sorted(self.calls.items()):
+            labels = [f'<={bound}ms' for bound in BUCKETS] + [f'>{BUCKETS[-1]}ms']
+            calls[name] = dict(call, histogram={label: n for label, n in zip(labels, call['histogram']) if n})
+            calls[name]['retries'] = max(call['attempts'] - call['calls'], 0)
+        return {
+            'command': self.command,
+            'seconds': time.perf_counter() - self.started,
+            'phases': self.phases,
+            'aws': calls,
+        }
+
+
+def enable(command=None):
+    """Start recording phases and AWS calls for this process"""
+    global _recorder
+    from .aws import add_client_hook
+    _recorder = Recorder(command)
+    add_client_hook(_recorder.instrument)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    from .aws import remove_client_hook
+    if _recorder is not None:
+        remove_client_hook(_recorder.instrument)
+        _recorder.uninstrument()
+        _recorder = None
+
+
+def recorder():
+    return _recorder
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the enclosed block as phase name, a no-op unless timings are enabled"""
+    if _recorder is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _recorder.add_phase(name, time.perf_counter() - started)
+
+
+def format_text(report):
+    lines = [f'envars {report["command"]}: {report["seconds"]:.3f}s']
+    for name, data in report['phases'].items():
+        lines.append(f'  {name:<24} {data["seconds"]:>8.3f}s  x{data["count"]}')
+    for name, data in report['aws'].items():
+        errors = ', '.join(f'{code}={n}' for code, n in sorted(data['errors'].items()))
+        lines.append(
+            f'  {name:<24} {data["seconds"]:>8.3f}s  calls={data["calls"]} retries={data["retries"]} '
+            f'throttled={data["throttled"]}{" errors: " + errors if errors else ""}'
+        )
+        lines.append('  ' + ' ' * 24 + '  ' + ' '.join(f'{label}:{n}' for label, n in data['histogram'].items()))
+    return '\n'.join(lines) + '\n'
+
+
+def write(fmt='text', path=None):
+    """Write the report once, as text or json, to path or stderr"""
+    if _recorder is None or _recorder.reported:
+        return
+    _recorder.reported = True
+    report = _recorder.report()
+    output = json.dumps(report, indent=2, sort_keys=True) + '\n' if fmt == 'json' else format_text(report)
+    if path:
+        with open(path, 'w') as f:
+            f.write(output)
+    else:
+        sys.stderr.write(output)
+        sys.stderr.flush()
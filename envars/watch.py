@@ -0,0 +1,106 @@
+import logging
+import signal
+import subprocess
+
+RESTART = 'restart'
+# seconds a restarted child has to exit after SIGTERM before it is killed
+STOP_TIMEOUT = 10
+
+
+def parse_on_change(value):
+    """Parse --on-change, either 'restart' or 'signal:NAME', returning 'restart' or a signal number"""
+    if value == RESTART:
+        return RESTART
+    if value.startswith('signal:'):
+        name = value.split(':', 1)[1].upper()
+        if not name.startswith('SIG'):
+            name = f'SIG{name}'
+        try:
+            return signal.Signals[name]
+        except KeyError:
+            pass
+    raise (Exception(f'Unknown --on-change action "{value}", expected "restart" or "signal:NAME"'))
+
+
+class ParameterWatcher(object):
+    """
+    Polls the parameter store values an environment uses with batched
+    fetches, reporting whether any changed since the last poll.
+    """
+
+    def __init__(self, envars, env, account, names=None, template_vars=None):
+        plan = envars.plan(env, account)
+        self.pnames = list(dict.fromkeys(plan.pstore_names(plan.select(names, template_vars))))
+        self.by_path_threshold = envars.pstore_by_path_threshold
+        self.values = None
+
+    def poll(self):
+        """
+        Fetch the values, returning whether they changed. A failed fetch keeps
+        the last values and counts as unchanged, except the first which raises.
+        """
+        if not self.pnames:
+            return False
+        from botocore.exceptions import BotoCoreError
+
+        from .ssm import ParameterStoreError, SsmAgent
+        try:
+            values = SsmAgent(by_path_threshold=self.by_path_threshold, strict=True).fetch_many(self.pnames)
+        except (ParameterStoreError, BotoCoreError) as e:
+            if self.values is None:
+                raise
+            logging.warning(f'parameter store poll failed, keeping the last values: {e}')
+            return False
+        changed = self.values is not None and values != self.values
+        if changed:
+            logging.debug(f'parameter store changed: {[n for n in self.pnames if values.get(n) != self.values.get(n)]}')
+        self.values = values
+        return changed
+
+
+class Supervisor(object):
+    """Runs command as a child, restarting or signalling it when its environment changes"""
+
+    def __init__(self, command, env, on_change=RESTART, stop_timeout=STOP_TIMEOUT):
+        self.command = command
+        self.env = env
+        self.on_change = on_change
+        self.stop_timeout = stop_timeout
+        self.child = None
+
+    def start(self):
+        self.child = subprocess.Popen(self.command, env=self.env)
+        return self.child
+
+    def forward(self, signum, frame=None):
+        if self.child and self.child.poll() is None:
+            self.child.send_signal(signum)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds, returning the child's exit code or None if still running"""
+        try:
+            return self.child.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def stop(self):
+        """Terminate the child if it is running, killing it if it ignores SIGTERM for stop_timeout seconds"""
+        if self.child is None or self.child.poll() is not None:
+            return
+        self.child.terminate()
+        try:
+            self.child.wait(timeout=self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            logging.debug(f'{self.command} ignored SIGTERM for {self.stop_timeout}s, killing it')
+            self.child.kill()
+            self.child.wait()
+
+    def changed(self, env):
+        self.env = env
+        if self.on_change == RESTART:
+            logging.debug(f'restarting {self.command}')
+            self.stop()
+            self.start()
+        else:
+            logging.debug(f'sending {self.on_change} to {self.command}')
+            self.forward(self.on_change)
@@ -18,6 +18,7 @@ setup(
         'pyyaml',
         'boto3',
         'jinja2',
+        'cryptography>=42.0.4',
     ],
     extra_require={
         'dev': ["pytest"],
@@ -1,19 +1,25 @@
 import pytest
 from botocore.stub import Stubber
 
-from envars.kms import kms_client
-from envars.ssm import ssm_client
+from envars.aws import get_client
 
 
 @pytest.fixture(scope='function', autouse=True)
 def kms_stub():
-    with Stubber(kms_client) as stubber:
+    with Stubber(get_client('kms')) as stubber:
         yield stubber
         stubber.assert_no_pending_responses()
 
 
 @pytest.fixture(scope='function', autouse=True)
 def ssm_stub():
-    with Stubber(ssm_client) as stubber:
+    with Stubber(get_client('ssm')) as stubber:
         yield stubber
         stubber.assert_no_pending_responses()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def offline_identity(monkeypatch, tmp_path):
+    """Keep account lookups off STS and caches out of the real home dir"""
+    monkeypatch.setenv('AWS_ACCOUNT_ID', '511042647617')
+    monkeypatch.setenv('ENVARS_CACHE_DIR', str(tmp_path / 'envars-cache'))
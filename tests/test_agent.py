@@ -0,0 +1,124 @@
+import threading
+
+import pytest
+
+from envars import envars as cli
+from envars.agent import AgentServer, EnvarsAgent, fetch_env
+from envars.models import EnVars, Secret
+
+
+def make_file(tmp_path):
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.app = 'testapp'
+    envars.envs = ['prod', 'staging']
+    envars.kms_key_arn = 'abc'
+    envars.add('DOMAIN', 'timeout.com')
+    envars.add('TOKEN', 'parameter_store:/app/{{ STAGE }}/TOKEN')
+    envars.save()
+    return envars.filename
+
+
+def add_token_response(ssm_stub, value='tok'):
+    ssm_stub.add_response(
+        'get_parameter',
+        service_response={'Parameter': {'Value': value}},
+        expected_params={'Name': '/app/prod/TOKEN', 'WithDecryption': True},
+    )
+
+
+@pytest.fixture
+def server(tmp_path):
+    agent = EnvarsAgent(make_file(tmp_path), ttl=60)
+    server = AgentServer(f'{tmp_path}/agent.sock', agent)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_agent_caches_resolved_env(ssm_stub, tmp_path, monkeypatch):
+    add_token_response(ssm_stub)
+    agent = EnvarsAgent(make_file(tmp_path), ttl=60)
+    template_vars = {'STAGE': 'prod'}
+    assert agent.resolve('prod', 'master', template_vars=template_vars) == {'DOMAIN': 'timeout.com', 'TOKEN': 'tok'}
+    assert agent.resolve('prod', 'master', template_vars=template_vars) == {'DOMAIN': 'timeout.com', 'TOKEN': 'tok'}
+
+    # expired values are resolved again
+    now = agent.values[next(iter(agent.values))][1] + 1
+    monkeypatch.setattr('envars.agent.time.monotonic', lambda: now)
+    add_token_response(ssm_stub, 'new')
+    assert agent.resolve('prod', 'master', template_vars=template_vars)['TOKEN'] == 'new'
+
+
+def test_agent_reloads_changed_file(ssm_stub, tmp_path):
+    agent = EnvarsAgent(make_file(tmp_path))
+    assert agent.resolve('staging', 'master', names=['DOMAIN']) == {'DOMAIN': 'timeout.com'}
+
+    envars = EnVars(agent.filename)
+    envars.load()
+    envars.add('DOMAIN', 'staging.timeout.com', 'staging')
+    envars.save()
+    agent.mtime = None
+    assert agent.resolve('staging', 'master', names=['DOMAIN']) == {'DOMAIN': 'staging.timeout.com'}
+
+
+def test_fetch_env_through_socket(ssm_stub, server, tmp_path):
+    add_token_response(ssm_stub)
+    path = server.server_address
+    kwargs = {'template_vars': {'STAGE': 'prod'}, 'path': path}
+    assert fetch_env(f'{tmp_path}/envars.yml', 'prod', 'master', **kwargs) == {'DOMAIN': 'timeout.com', 'TOKEN': 'tok'}
+    assert fetch_env(f'{tmp_path}/envars.yml', 'prod', 'master', names=['DOMAIN'], **kwargs) == {'DOMAIN': 'timeout.com'}
+
+    with pytest.raises(Exception, match='Unknown Env: "dev"'):
+        fetch_env(f'{tmp_path}/envars.yml', 'dev', 'master', **kwargs)
+
+    # another file, or no agent at all, falls back to direct resolution
+    assert fetch_env(f'{tmp_path}/other.yml', 'prod', 'master', **kwargs) is None
+    assert fetch_env(f'{tmp_path}/envars.yml', 'prod', 'master', path=f'{tmp_path}/missing.sock') is None
+
+
+def test_process_uses_agent(ssm_stub, server, tmp_path):
+    add_token_response(ssm_stub)
+    args = type('Args', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': False,
+        'quote': False,
+        'socket': server.server_address,
+    })
+    assert cli.process(args) == ['DOMAIN=timeout.com', 'TOKEN=tok']
+    # served from the agent's memory, no further parameter store calls
+    assert cli.process(args) == ['DOMAIN=timeout.com', 'TOKEN=tok']
+
+
+def test_process_uses_agent_with_secret(ssm_stub, server, tmp_path, monkeypatch):
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.load()
+    envars.add('PASSWORD', Secret('Y2lwaGVydGV4dA=='))
+    envars.save()
+    add_token_response(ssm_stub)
+    args = type('Args', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': False,
+        'quote': False,
+        'socket': server.server_address,
+    })
+    # the agent must answer, not fall back to resolving directly
+    monkeypatch.setattr(cli, 'load_envars', lambda *args: pytest.fail('resolved without the agent'))
+    assert cli.process(args) == ['DOMAIN=timeout.com', 'TOKEN=tok', 'PASSWORD=Y2lwaGVydGV4dA==']
+
+    args.yaml = True
+    assert '  PASSWORD: !secret |-\n    Y2lwaGVydGV4dA==\n' in cli.process(args)
+
+
+def test_agent_socket_in_use(server, tmp_path):
+    with pytest.raises(Exception, match='already listening'):
+        AgentServer(server.server_address, server.agent)
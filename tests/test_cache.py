@@ -0,0 +1,88 @@
+import os
+import time
+
+from envars.cache import SecretCache
+
+
+class FakeKMSAgent(object):
+
+    def __init__(self):
+        self.key = os.urandom(32)
+        self.generated = 0
+        self.decrypted = 0
+
+    def generate_data_key(self, encryption_context):
+        self.generated += 1
+        return self.key, 'ZW5jcnlwdGVkLWtleQ=='
+
+    def decrypt_data_key(self, base64_ciphertext, encryption_context):
+        self.decrypted += 1
+        return self.key
+
+
+def test_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'run'))
+    agent = FakeKMSAgent()
+    cache = SecretCache(agent, 'testapp', directory=str(tmp_path))
+    cache.put('Y2lwaGVy', {'app': 'testapp', 'env': 'prod'}, 'sssssh')
+    cache.save()
+
+    with open(cache.path, 'rb') as f:
+        assert b'sssssh' not in f.read()
+
+    cache = SecretCache(agent, 'testapp', directory=str(tmp_path))
+    assert cache.get('Y2lwaGVy', {'env': 'prod', 'app': 'testapp'}) == 'sssssh'
+    assert cache.get('Y2lwaGVy', {'app': 'testapp'}) is None
+    assert agent.generated == 1
+    assert agent.decrypted == 0
+
+
+def test_cache_recovers_lost_key_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'run'))
+    agent = FakeKMSAgent()
+    cache = SecretCache(agent, 'testapp', directory=str(tmp_path))
+    cache.put('Y2lwaGVy', {'app': 'testapp'}, 'sssssh')
+    cache.save()
+    assert os.path.dirname(cache.key_path) == str(tmp_path / 'run' / 'envars')
+    os.remove(cache.key_path)
+
+    cache = SecretCache(agent, 'testapp', directory=str(tmp_path))
+    assert cache.get('Y2lwaGVy', {'app': 'testapp'}) == 'sssssh'
+    assert agent.decrypted == 1
+
+
+def test_key_never_stored_with_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    agent = FakeKMSAgent()
+    cache = SecretCache(agent, 'testapp', directory=str(tmp_path))
+    cache.put('Y2lwaGVy', {'app': 'testapp'}, 'sssssh')
+    cache.save()
+    assert cache.key_path is None
+    assert os.listdir(tmp_path) == ['testapp.cache']
+
+    # each process unwraps the data key with KMS instead
+    cache = SecretCache(agent, 'testapp', directory=str(tmp_path))
+    assert cache.get('Y2lwaGVy', {'app': 'testapp'}) == 'sssssh'
+    assert agent.decrypted == 1
+
+    # nor when the cache itself is pointed at the runtime dir
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'run'))
+    assert SecretCache(agent, 'testapp', directory=str(tmp_path / 'run' / 'envars')).key_path is None
+
+
+def test_cache_lru_eviction_and_ttl(tmp_path, monkeypatch):
+    agent = FakeKMSAgent()
+    cache = SecretCache(agent, 'testapp', ttl=60, max_entries=2, directory=str(tmp_path))
+    cache.put('a', {'app': 'testapp'}, 'A')
+    cache.put('b', {'app': 'testapp'}, 'B')
+    assert cache.get('a', {'app': 'testapp'}) == 'A'
+    cache.put('c', {'app': 'testapp'}, 'C')
+
+    assert cache.get('b', {'app': 'testapp'}) is None
+    assert cache.get('a', {'app': 'testapp'}) == 'A'
+    assert cache.get('c', {'app': 'testapp'}) == 'C'
+
+    now = time.time()
+    monkeypatch.setattr('envars.cache.time.time', lambda: now + 61)
+    assert cache.get('a', {'app': 'testapp'}) is None
+    assert cache.stats()['expired'] == 2
@@ -2,9 +2,11 @@ import os
 import subprocess
 from unittest.mock import MagicMock
 
+import pytest
 import yaml
 
 from envars import envars
+from envars.models import get_loader
 
 CMD = 'python -m envars.envars'
 
@@ -479,3 +481,396 @@ def test_var_from_env(tmp_path):
     os.environ["RELEASE_SHA"] = '12345'
     ret = envars.process(args)
     assert ret == ['TEST=12345']
+
+
+def test_secrets_decrypted_in_file_order(kms_stub, tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    for name in ['A_SECRET', 'B_SECRET']:
+        kms_stub.add_response(
+            'encrypt',
+            service_response={'CiphertextBlob': name.encode()}
+        )
+        args = type('Arg', (object,), {
+            'variable': f'{name}=sssssh',
+            'secret': True,
+            'filename': f'{tmp_path}/envars.yml',
+            'env': 'default',
+            'desc': None,
+            'account': None,
+        })
+        envars.add_var(args)
+    for _ in range(2):
+        kms_stub.add_response(
+            'decrypt',
+            service_response={'KeyId': 'TEST', 'Plaintext': b'sssssh', 'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT'}
+        )
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': True,
+        'quote': False,
+        'no_check_env': False,
+        'kms_concurrency': 2,
+    })
+    ret = envars.process(args)
+
+    assert ret == ['A_SECRET=sssssh', 'B_SECRET=sssssh']
+
+
+def test_parameter_store_values_fetched_in_one_call(ssm_stub, tmp_path):
+    ssm_stub.add_response(
+        'get_parameters',
+        service_response={
+            'Parameters': [{'Name': '/gp-web/prod/ONE', 'Value': '1'}],
+            'InvalidParameters': ['/gp-web/prod/TWO'],
+        },
+        expected_params={'Names': ['/gp-web/prod/ONE', '/gp-web/prod/TWO'], 'WithDecryption': True},
+    )
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    for variable in [
+        'PONE=parameter_store:/gp-web/{{ STAGE }}/ONE',
+        'PTWO=parameter_store:/gp-web/prod/TWO',
+        'PTHREE=parameter_store:/gp-web/prod/ONE',
+    ]:
+        args = type('Arg', (object,), {
+            'variable': variable,
+            'secret': False,
+            'filename': f'{tmp_path}/envars.yml',
+            'env': 'default',
+            'desc': None,
+            'account': None,
+        })
+        envars.add_var(args)
+
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': False,
+        'quote': False,
+        'no_check_env': False,
+    })
+    ret = envars.process(args)
+    assert ret == ['PONE=1', 'PTHREE=1', 'PTWO=NOT-FOUND-IN-PSTORE-/gp-web/prod/TWO']
+
+
+def test_secret_cache_avoids_kms(kms_stub, tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', f'{tmp_path}/run')
+    kms_stub.add_response(
+        'encrypt',
+        service_response={'CiphertextBlob': b'dfghsdghfsd'}
+    )
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    args = type('Arg', (object,), {
+        'variable': 'TEST=sssssh',
+        'secret': True,
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'default',
+        'desc': None,
+        'account': None,
+    })
+    envars.add_var(args)
+
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'KeyId': 'TEST', 'Plaintext': b'sssssh', 'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT'}
+    )
+    kms_stub.add_response(
+        'generate_data_key',
+        service_response={'KeyId': 'TEST', 'Plaintext': os.urandom(32), 'CiphertextBlob': b'datakey'}
+    )
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': True,
+        'quote': False,
+        'no_check_env': False,
+        'cache_ttl': 300,
+        'cache_dir': f'{tmp_path}/cache',
+    })
+    assert envars.process(args) == ['TEST=sssssh']
+    # served from the on-disk cache, no further KMS calls are stubbed
+    assert envars.process(args) == ['TEST=sssssh']
+
+
+def test_migrate_envelope(kms_stub, tmp_path):
+    data_key = os.urandom(32)
+    kms_stub.add_response(
+        'encrypt',
+        service_response={'CiphertextBlob': b'dfghsdghfsd'}
+    )
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    args = type('Arg', (object,), {
+        'variable': 'TEST=sssssh',
+        'secret': True,
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'default',
+        'desc': None,
+        'account': None,
+    })
+    envars.add_var(args)
+
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'KeyId': 'TEST', 'Plaintext': b'sssssh', 'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT'}
+    )
+    kms_stub.add_response(
+        'generate_data_key',
+        service_response={'KeyId': 'TEST', 'Plaintext': data_key, 'CiphertextBlob': b'datakey'},
+        expected_params={'KeyId': 'abc', 'KeySpec': 'AES_256', 'EncryptionContext': {'app': 'testapp'}},
+    )
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'envelope': True,
+    })
+    envars.migrate(args)
+
+    with open(f'{tmp_path}/envars.yml', 'rb') as f:
+        yml = yaml.load(f, Loader=get_loader())
+    assert yml['environment_variables']['TEST']['default'].value.startswith('envelope:')
+    assert 'default' in yml['configuration']['DATA_KEYS']
+
+    args = type('Arg', (object,), {
+        'variable': 'TEST2=quiet',
+        'secret': True,
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'default',
+        'desc': None,
+        'account': None,
+    })
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'KeyId': 'TEST', 'Plaintext': data_key, 'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT'}
+    )
+    envars.add_var(args)
+
+    # one KMS call for the data key regardless of the number of secrets
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'KeyId': 'TEST', 'Plaintext': data_key, 'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT'},
+        expected_params={'CiphertextBlob': b'datakey', 'EncryptionContext': {'app': 'testapp'}},
+    )
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': True,
+        'quote': False,
+        'no_check_env': False,
+    })
+    assert envars.process(args) == ['TEST=sssssh', 'TEST2=quiet']
+
+
+def test_print_selected_vars_only(ssm_stub, tmp_path):
+    ssm_stub.add_response(
+        'get_parameter',
+        service_response={'Parameter': {'Value': 'example.com'}},
+        expected_params={'Name': '/gp-web/prod/DOMAIN', 'WithDecryption': True},
+    )
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    for variable in [
+        'DOMAIN=parameter_store:/gp-web/{{ STAGE }}/DOMAIN',
+        'HOSTNAME=www.{{ DOMAIN }}',
+        'UNUSED=parameter_store:/gp-web/prod/UNUSED',
+        'PORT=8000',
+    ]:
+        args = type('Arg', (object,), {
+            'variable': variable,
+            'secret': False,
+            'filename': f'{tmp_path}/envars.yml',
+            'env': 'default',
+            'desc': None,
+            'account': None,
+        })
+        envars.add_var(args)
+
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'var': ['hostname,PORT'],
+        'template_var': [],
+        'yaml': False,
+        'decrypt': True,
+        'quote': False,
+        'no_check_env': False,
+    })
+    assert envars.process(args) == ['HOSTNAME=www.example.com', 'PORT=8000']
+
+
+def test_import(kms_stub, tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    with open(f'{tmp_path}/vars.env', 'w') as f:
+        f.write('# imported\nexport ONE=1\nTWO="two=2"\n\nTHREE=\n')
+    args = type('Arg', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'input': f'{tmp_path}/vars.env',
+        'format': None,
+        'env': 'prod',
+        'account': None,
+        'secret': False,
+        'desc': None,
+    })
+    envars.import_vars(args)
+
+    for name in ['A_SECRET', 'B_SECRET']:
+        kms_stub.add_response(
+            'encrypt',
+            service_response={'CiphertextBlob': name.encode()},
+        )
+    with open(f'{tmp_path}/vars.yml', 'w') as f:
+        f.write('ONE: uno\nA_SECRET:\n  value: a\n  secret: true\nB_SECRET:\n  value: b\n  secret: true\n  account: master\n')
+    args.input = f'{tmp_path}/vars.yml'
+    args.env = 'default'
+    args.kms_concurrency = 1
+    envars.import_vars(args)
+
+    with open(f'{tmp_path}/envars.yml', 'rb') as f:
+        yml = yaml.load(f, Loader=get_loader())['environment_variables']
+    assert yml['ONE'] == {'default': 'uno', 'prod': '1'}
+    assert yml['TWO'] == {'prod': 'two=2'}
+    assert yml['THREE'] == {'prod': ''}
+    assert yml['A_SECRET']['default'].value == 'QV9TRUNSRVQ='
+    assert yml['B_SECRET']['default']['master'].value == 'Ql9TRUNSRVQ='
+
+
+def test_import_scalar_values():
+    from envars.importer import parse_entries
+    entries = parse_entries('ENABLED: yes\nDISABLED: false\nPORT: 8000\nRATIO: 1.5\nDAY: 2024-01-31\n', 'yaml')
+    assert [(name, value) for name, value, *_ in entries] == [
+        ('ENABLED', 'true'), ('DISABLED', 'false'), ('PORT', '8000'), ('RATIO', '1.5'), ('DAY', '2024-01-31'),
+    ]
+    with pytest.raises(Exception, match='"EMPTY" has a null value'):
+        parse_entries('EMPTY: null\n', 'yaml')
+    with pytest.raises(Exception, match='"HOSTS" value must be a string, number or boolean, not list'):
+        parse_entries('{"HOSTS": ["a", "b"]}', 'json')
+    with pytest.raises(Exception, match='not dict'):
+        parse_entries('{"HOST": {"value": {"a": 1}}}', 'json')
+
+
+def test_validate_template_cycle(tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, "add 'AA={{ BB }}'")
+    run_cmd(tmp_path, 'add BB=b')
+    ret = run_cmd(tmp_path, 'validate')
+    assert ret.returncode == 0
+
+    run_cmd(tmp_path, "add -e prod 'BB={{ AA }}'")
+    ret = subprocess.run(f'{CMD} -f {tmp_path}/envars.yml validate', shell=True, capture_output=True)
+    assert ret.returncode == 1
+    assert b'"prod" "master" Template cycle detected: AA -> BB -> AA' in ret.stdout
+    assert b'"staging"' not in ret.stdout
+
+
+def test_commands_without_aws_skip_boto3(tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, 'add TEST=test')
+    for cmd in ['validate', 'print -a master -e prod', 'print -a master']:
+        ret = subprocess.run(
+            f'python -X importtime -m envars.envars -f {tmp_path}/envars.yml {cmd}',
+            shell=True,
+            capture_output=True,
+            text=True,
+        )
+        assert ret.returncode == 0
+        assert ' boto3' not in ret.stderr
+        assert ' botocore' not in ret.stderr
+
+
+def test_aws_clients_shared(monkeypatch):
+    from envars import aws
+    created = []
+    monkeypatch.setattr(aws, '_clients', {})
+    session = type('Session', (object,), {'client': lambda self, name, config=None: created.append(name) or name})()
+    monkeypatch.setattr(aws, 'session', lambda: session)
+    assert aws.get_client('kms') == 'kms'
+    assert aws.get_client('kms') == 'kms'
+    assert aws.get_client('sts') == 'sts'
+    assert created == ['kms', 'sts']
+
+
+def test_configured_accounts(tmp_path, monkeypatch):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    with open(f'{tmp_path}/envars.yml') as f:
+        data = f.read()
+    with open(f'{tmp_path}/envars.yml', 'w') as f:
+        f.write(data.replace('configuration:\n', "configuration:\n\n  ACCOUNTS:\n    '123456789012': staging-acct\n"))
+
+    ret = run_cmd(tmp_path, 'add -e prod -a master TEST=master')
+    assert ret.returncode == 1
+    ret = run_cmd(tmp_path, 'add -e prod -a staging-acct TEST=account')
+    assert ret.returncode == 0
+    with open(f'{tmp_path}/envars.yml') as f:
+        assert "ACCOUNTS:\n    '123456789012': staging-acct\n" in f.read()
+
+    monkeypatch.setenv('AWS_ACCOUNT_ID', '123456789012')
+    args = type('Args', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': None,
+        'decrypt': False,
+        'yaml': False,
+        'quote': False,
+    })
+    assert envars.process(args) == ['TEST=account']
+
+
+def test_set_systemd_env_environment_file(tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, "add 'TEST=it'\"'\"'s'")
+    ret = run_cmd(tmp_path, f'set-systemd-env -e prod -a master --environment-file {tmp_path}/envars.env')
+    assert ret.returncode == 0
+    with open(f'{tmp_path}/envars.env') as f:
+        assert f.read() == 'TEST="it\'s"\n'
+
+
+def test_print_all_envs(tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, "add 'HOST={{ STAGE }}.timeout.com'")
+    run_cmd(tmp_path, 'add -e prod -a sandbox HOST=sandbox.timeout.com')
+    ret = run_cmd(tmp_path, f'print --all-envs --accounts master,sandbox --output-dir {tmp_path}/out')
+    assert ret.returncode == 0
+    assert sorted(os.listdir(f'{tmp_path}/out')) == ['prod-master.env', 'prod-sandbox.env', 'staging-master.env', 'staging-sandbox.env']
+    with open(f'{tmp_path}/out/prod-master.env') as f:
+        assert f.read() == 'HOST=prod.timeout.com\n'
+    with open(f'{tmp_path}/out/prod-sandbox.env') as f:
+        assert f.read() == 'HOST=sandbox.timeout.com\n'
+    with open(f'{tmp_path}/out/staging-sandbox.env') as f:
+        assert f.read() == 'HOST=staging.timeout.com\n'
+
+
+def test_var_without_account_skips_lookup(tmp_path, monkeypatch):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, 'add TEST=test')
+    run_cmd(tmp_path, 'add -e prod -a sandbox SCOPED=sandbox')
+    run_cmd(tmp_path, "add 'URL={{ SCOPED }}.timeout.com'")
+    lookups = []
+    monkeypatch.setattr(envars, 'get_account', lambda e: lookups.append(e) or 'sandbox')
+    args = type('Args', (object,), {
+        'account': None,
+        'env': 'prod',
+        'filename': f'{tmp_path}/envars.yml',
+        'template_var': [],
+        'yaml': False,
+        'decrypt': False,
+        'quote': False,
+        'no_agent': True,
+        'var': 'TEST',
+    })
+    assert envars.process(args) == ['TEST=test']
+    assert lookups == []
+
+    # a template using an account specific value needs the account
+    args.var = 'URL'
+    assert envars.process(args) == ['URL=sandbox.timeout.com']
+    assert len(lookups) == 1
@@ -0,0 +1,62 @@
+import pytest
+from botocore.stub import Stubber
+
+from envars.aws import get_client
+from envars.identity import caller_account_id
+
+
+@pytest.fixture(scope='function')
+def sts_stub(monkeypatch):
+    monkeypatch.delenv('AWS_ACCOUNT_ID', raising=False)
+    with Stubber(get_client('sts')) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def identity(account_id):
+    return {'Account': account_id, 'Arn': f'arn:aws:iam::{account_id}:user/test', 'UserId': 'test'}
+
+
+def test_account_id_from_environment(sts_stub, monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCOUNT_ID', '123456789012')
+    assert caller_account_id(directory=tmp_path) == '123456789012'
+
+
+def use_access_key(monkeypatch, access_key):
+    credentials = type('Credentials', (object,), {'access_key': access_key})()
+    session = type('Session', (object,), {'get_credentials': lambda self: credentials})()
+    monkeypatch.setattr('envars.aws.session', lambda: session)
+
+
+def test_caller_identity_cached(sts_stub, monkeypatch, tmp_path):
+    use_access_key(monkeypatch, 'AKIAONE')
+    sts_stub.add_response('get_caller_identity', identity('511042647617'), {})
+    assert caller_account_id(directory=tmp_path) == '511042647617'
+    assert caller_account_id(directory=tmp_path) == '511042647617'
+
+    # other credentials under the same profile are looked up again
+    use_access_key(monkeypatch, 'AKIATWO')
+    sts_stub.add_response('get_caller_identity', identity('253613363555'), {})
+    assert caller_account_id(directory=tmp_path) == '253613363555'
+
+    use_access_key(monkeypatch, 'AKIAONE')
+    assert caller_account_id(directory=tmp_path) == '511042647617'
+    assert 'AKIAONE' not in (tmp_path / 'identity.json').read_text()
+
+
+def test_caller_identity_expires(sts_stub, monkeypatch, tmp_path):
+    sts_stub.add_response('get_caller_identity', identity('511042647617'), {})
+    sts_stub.add_response('get_caller_identity', identity('511042647617'), {})
+    now = 1000000
+    monkeypatch.setattr('envars.identity.time.time', lambda: now)
+    caller_account_id(ttl=60, directory=tmp_path)
+    now += 61
+    caller_account_id(ttl=60, directory=tmp_path)
+
+
+def test_caller_identity_ttl_zero(sts_stub, tmp_path):
+    sts_stub.add_response('get_caller_identity', identity('511042647617'), {})
+    sts_stub.add_response('get_caller_identity', identity('511042647617'), {})
+    caller_account_id(ttl=0, directory=tmp_path)
+    caller_account_id(ttl=0, directory=tmp_path)
+    assert not (tmp_path / 'identity.json').exists()
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+from botocore.exceptions import ReadTimeoutError
+
+from envars import aws, kms
+from envars.aws import get_client
+from envars.kms import KMSAgent
+
+
+def test_decrypt_retries_on_throttling(kms_stub, monkeypatch):
+    monkeypatch.setattr(kms.time, 'sleep', lambda s: None)
+    kms_stub.add_client_error('decrypt', service_error_code='ThrottlingException')
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'KeyId': 'TEST', 'Plaintext': b'sssssh', 'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT'}
+    )
+    agent = KMSAgent('abc')
+    assert agent.decrypt('ZGZnaHNkZ2hmc2Q=', {'app': 'testapp'}) == 'sssssh'
+
+
+def test_decrypt_many_preserves_order(monkeypatch):
+    def decrypt(self, base64_ciphertext, encryption_context):
+        time.sleep(0.01 * (5 - int(base64_ciphertext)))
+        return f"plain-{base64_ciphertext}-{encryption_context['env']}"
+
+    monkeypatch.setattr(KMSAgent, 'decrypt', decrypt)
+    agent = KMSAgent('abc', concurrency=5)
+    items = [(str(i), {'app': 'testapp', 'env': 'prod'}) for i in range(5)]
+    assert agent.decrypt_many(items) == [f'plain-{i}-prod' for i in range(5)]
+
+
+def test_identical_ciphertexts_decrypted_once(kms_stub):
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'Plaintext': b'shared'},
+        expected_params={'CiphertextBlob': b'cipher', 'EncryptionContext': {'app': 'testapp'}},
+    )
+    kms_stub.add_response(
+        'decrypt',
+        service_response={'Plaintext': b'prod'},
+        expected_params={'CiphertextBlob': b'cipher', 'EncryptionContext': {'app': 'testapp', 'env': 'prod'}},
+    )
+    agent = KMSAgent('abc', concurrency=1)
+    items = [
+        ('Y2lwaGVy', {'app': 'testapp'}),
+        ('Y2lwaGVy', {'app': 'testapp'}),
+        ('Y2lwaGVy', {'app': 'testapp', 'env': 'prod'}),
+        ('Y2lwaGVy', {'app': 'testapp'}),
+    ]
+    assert agent.decrypt_many(items) == ['shared', 'shared', 'prod', 'shared']
+    assert agent.flight.stats() == {'hits': 2, 'shared': 0, 'misses': 2}
+
+
+def test_kms_timeout_is_reported():
+    def hang(**kwargs):
+        raise ReadTimeoutError(endpoint_url='https://kms.eu-west-1.amazonaws.com/')
+
+    agent = KMSAgent('abc', concurrency=2)
+    with pytest.raises(Exception, match='KMS call timed out.*ENVARS_AWS_READ_TIMEOUT'):
+        agent._map(lambda *item: agent._call(hang), [(str(i), {'app': 'testapp'}) for i in range(4)])
+
+
+def test_clients_have_timeouts():
+    config = get_client('kms').meta.config
+    assert config.connect_timeout == aws.CONNECT_TIMEOUT
+    assert config.read_timeout == aws.READ_TIMEOUT
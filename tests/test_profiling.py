@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from envars import profiling
+from tests.test_cli import run_cmd
+from tests.test_resolver import make_envars
+
+
+@pytest.fixture
+def profile():
+    profile = profiling.enable()
+    yield profile
+    profiling.disable()
+
+
+def test_cost_noop_when_disabled():
+    with profiling.cost('HOST', 'render'):
+        pass
+    assert profiling.profile() is None
+
+
+def test_shared_resource_split_between_owners(profile):
+    profile.add('A', 'render', 1.0)
+    profile.add_resource('pstore', '/app/TOKEN', 4.0)
+    profile.own('pstore', '/app/TOKEN', 'A')
+    profile.own('pstore', '/app/TOKEN', 'B')
+    rows = {row['name']: row for row in profile.report()}
+    assert rows['A']['pstore'] == 2.0
+    assert rows['B']['pstore'] == 2.0
+    assert rows['A']['total'] == 3.0
+    assert [row['name'] for row in profile.report()] == ['A', 'B']
+
+
+def test_build_env_costs_per_variable(profile, ssm_stub, kms_stub):
+    ssm_stub.add_response(
+        'get_parameter',
+        service_response={'Parameter': {'Value': 'tok'}},
+        expected_params={'Name': '/app/prod/TOKEN', 'WithDecryption': True},
+    )
+    kms_stub.add_response('decrypt', service_response={'Plaintext': b'sssssh'})
+    make_envars().build_env('prod', 'master', decrypt=True, template_vars={'STAGE': 'prod'})
+
+    rows = {row['name']: row for row in profile.report()}
+    assert all(rows[name]['lookup'] > 0 for name in ['DOMAIN', 'HOST', 'TOKEN', 'KEY'])
+    assert rows['TOKEN']['pstore'] > 0
+    assert rows['KEY']['decrypt'] > 0
+    assert rows['HOST']['render'] > 0
+    assert 'TOKEN' in profiling.format_text(profile.report())
+
+
+def test_cli_profile(tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, "add 'HOST={{ STAGE }}.timeout.com'")
+    ret = run_cmd(tmp_path, f'--profile {tmp_path}/out.pstats print -e prod -a master')
+    assert ret.returncode == 0
+    assert os.path.getsize(f'{tmp_path}/out.pstats') > 0
+    with open(f'{tmp_path}/out.pstats.variables.json') as f:
+        rows = json.load(f)
+    assert rows[0]['name'] == 'HOST'
+    assert rows[0]['render'] > 0
+    assert rows[0]['lookup'] > 0
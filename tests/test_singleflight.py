@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from envars.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_call():
+    flight = SingleFlight(memoize=False)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return value * 2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('k', slow, 21))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.shared < 4:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [21]
+    assert results == [42] * 5
+    assert flight.stats() == {'hits': 0, 'shared': 4, 'misses': 1}
+
+    # not memoized, a later call runs again
+    flight.do('k', lambda: 1)
+    assert flight.misses == 2
+
+
+def test_memoized_results_and_errors():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 'one') == 'one'
+    assert flight.do('a', lambda: 'two') == 'one'
+    assert flight.stats() == {'hits': 1, 'shared': 0, 'misses': 1}
+
+    def fail():
+        raise ValueError('boom')
+    with pytest.raises(ValueError):
+        flight.do('b', fail)
+    # failures are not remembered
+    assert flight.do('b', lambda: 'ok') == 'ok'
+
+    flight.reset()
+    assert flight.do('a', lambda: 'two') == 'two'
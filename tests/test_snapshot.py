@@ -0,0 +1,101 @@
+import os
+import time
+
+import yaml
+
+from envars import envars as cli
+from envars.models import EnVars, Secret, get_loader
+from envars.snapshot import snapshot_path
+
+
+def make_file(tmp_path):
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.app = 'testapp'
+    envars.envs = ['prod', 'staging']
+    envars.kms_key_arn = 'abc'
+    envars.add('DOMAIN', 'timeout.com')
+    envars.add('DOMAIN', 'prod.timeout.com', 'prod')
+    envars.add('HOST', 'www.{{ DOMAIN }}', desc='host name')
+    envars.add('KEY', Secret('Y2lwaGVy'), 'prod', account='master')
+    envars.save()
+    return envars.filename
+
+
+def test_snapshot_used_when_hash_matches(tmp_path):
+    filename = make_file(tmp_path)
+    args = type('Args', (object,), {'filename': filename, 'output': None})
+    cli.compile_envars(args)
+    assert os.path.exists(snapshot_path(filename))
+
+    envars = EnVars(filename)
+    envars.load()
+    assert ('prod', 'master') in envars.layouts
+    assert envars.index.get('HOST').desc == 'host name'
+    values = envars.build_env('prod', 'master', template_vars={})
+    assert values['HOST'] == 'www.prod.timeout.com'
+    assert values['KEY'].value == 'Y2lwaGVy'
+
+    plain = EnVars(filename)
+    with open(filename, 'rb') as f:
+        plain.populate(yaml.load(f, Loader=get_loader()))
+    assert plain.build_env('prod', 'master', template_vars={})['HOST'] == values['HOST']
+
+
+def test_stale_snapshot_ignored(tmp_path):
+    filename = make_file(tmp_path)
+    cli.compile_envars(type('Args', (object,), {'filename': filename, 'output': None}))
+
+    envars = EnVars(filename)
+    envars.load()
+    envars.add('NEW', 'new')
+    assert envars.layouts == {}
+    envars.save()
+
+    envars = EnVars(filename)
+    envars.load()
+    assert envars.layouts == {}
+    assert envars.index.get('NEW') is not None
+
+
+def test_snapshot_unpacks_lazily(tmp_path):
+    filename = make_file(tmp_path)
+    cli.compile_envars(type('Args', (object,), {'filename': filename, 'output': None}))
+
+    envars = EnVars(filename)
+    envars.load()
+    assert envars.count() == 3
+    assert all(isinstance(rows, bytes) for rows in envars.layouts.values())
+    assert envars.build_env('staging', None, template_vars={})['DOMAIN'] == 'timeout.com'
+    assert envars._packed is not None
+    assert isinstance(envars.layouts[('prod', 'master')], bytes)
+
+    assert [var.name for var in envars.envars] == ['DOMAIN', 'HOST', 'KEY']
+    assert envars._packed is None
+
+
+def test_snapshot_faster_than_yaml(tmp_path):
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.app = 'testapp'
+    envars.envs = ['prod', 'staging', 'dev']
+    envars.kms_key_arn = 'abc'
+    for i in range(1000):
+        envars.add(f'VAR_{i}', f'value {i}')
+        envars.add(f'VAR_{i}', f'https://{{{{ STAGE }}}}.timeout.com/{i}', 'prod', account='master')
+    envars.save()
+    cli.compile_envars(type('Args', (object,), {'filename': envars.filename, 'output': None}))
+
+    def best(load_snapshot):
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            loaded = EnVars(envars.filename)
+            if load_snapshot:
+                loaded.load()
+            else:
+                with open(envars.filename, 'rb') as f:
+                    loaded.populate(yaml.load(f, Loader=get_loader()))
+            loaded.table('prod', 'master')
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    assert best(True) < best(False)
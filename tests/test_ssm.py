@@ -0,0 +1,45 @@
+from envars.ssm import SsmAgent
+
+
+def test_fetch_many_batches_get_parameters(ssm_stub):
+    names = [f'/app/prod/VAR{i}' for i in range(12)]
+    ssm_stub.add_response(
+        'get_parameters',
+        service_response={
+            'Parameters': [{'Name': name, 'Value': name[-4:]} for name in names[:9]],
+            'InvalidParameters': [names[9]],
+        },
+        expected_params={'Names': names[:10], 'WithDecryption': True},
+    )
+    ssm_stub.add_response(
+        'get_parameters',
+        service_response={'Parameters': [{'Name': name, 'Value': name[-4:]} for name in names[10:]]},
+        expected_params={'Names': names[10:], 'WithDecryption': True},
+    )
+    values = SsmAgent().fetch_many(names + names[:3])
+
+    assert len(values) == 12
+    assert values['/app/prod/VAR0'] == 'VAR0'
+    assert values['/app/prod/VAR9'] == 'NOT-FOUND-IN-PSTORE-/app/prod/VAR9'
+    assert values['/app/prod/VAR11'] == 'AR11'
+
+
+def test_fetch_many_by_path(ssm_stub):
+    names = ['/app/prod/A', '/app/prod/B', '/other/C']
+    ssm_stub.add_response(
+        'get_parameters_by_path',
+        service_response={'Parameters': [
+            {'Name': '/app/prod/A', 'Value': 'a'},
+            {'Name': '/app/prod/B', 'Value': 'b'},
+            {'Name': '/app/prod/UNUSED', 'Value': 'x'},
+        ]},
+        expected_params={'Path': '/app/prod', 'Recursive': False, 'WithDecryption': True},
+    )
+    ssm_stub.add_response(
+        'get_parameter',
+        service_response={'Parameter': {'Value': 'c'}},
+        expected_params={'Name': '/other/C', 'WithDecryption': True},
+    )
+    values = SsmAgent(by_path_threshold=2).fetch_many(names)
+
+    assert values == {'/app/prod/A': 'a', '/app/prod/B': 'b', '/other/C': 'c'}
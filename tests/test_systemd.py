@@ -0,0 +1,28 @@
+import os
+import stat
+
+from envars import systemd
+
+
+def test_set_environment_single_call(monkeypatch):
+    calls = []
+    monkeypatch.setattr(systemd.subprocess, 'run', lambda argv, check: calls.append(argv))
+    systemd.set_environment({'A': '1', 'B': "it's", 'C': 'x y'})
+    assert calls == [['systemctl', 'set-environment', 'A=1', "B=it's", 'C=x y']]
+
+
+def test_set_environment_chunked(monkeypatch):
+    calls = []
+    monkeypatch.setattr(systemd.subprocess, 'run', lambda argv, check: calls.append(argv))
+    values = {f'VAR_{i}': 'x' * 10 for i in range(10)}
+    systemd.set_environment(values, limit=64)
+    assert [len(call) - 2 for call in calls] == [3, 3, 3, 1]
+    assert [a for call in calls for a in call[2:]] == [f'{k}={v}' for k, v in values.items()]
+
+
+def test_write_environment_file(tmp_path):
+    path = f'{tmp_path}/envars.env'
+    systemd.write_environment_file(path, {'A': '1', 'B': 'say "hi" $HOME `x` \\', 'C': 'two\nlines'})
+    with open(path) as f:
+        assert f.read() == 'A="1"\nB="say \\"hi\\" \\$HOME \\`x\\` \\\\"\nC="two\nlines"\n'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -0,0 +1,31 @@
+from envars import templates
+from envars.models import EnVars
+
+
+def test_render_skips_values_without_markers():
+    templates.compile_template.cache_clear()
+    assert templates.render('plain value\n', {}) == 'plain value\n'
+    assert templates.render(8080, {}) == 8080
+    assert templates.compile_template.cache_info().currsize == 0
+
+
+def test_render_compiles_each_template_once():
+    templates.compile_template.cache_clear()
+    for stage in ['prod', 'staging', 'prod']:
+        assert templates.render('{{ STAGE }}.timeout.com', {'STAGE': stage}) == f'{stage}.timeout.com'
+    info = templates.compile_template.cache_info()
+    assert (info.misses, info.hits) == (1, 2)
+
+
+def test_precompile():
+    templates.compile_template.cache_clear()
+    envars = EnVars()
+    envars.app = 'testapp'
+    envars.envs = ['prod']
+    envars.add('DOMAIN', 'timeout.com')
+    envars.add('HOST', 'www.{{ DOMAIN }}')
+    envars.add('HOST', 'prod.{{ DOMAIN }}', 'prod')
+    envars.add('TOKEN', 'parameter_store:/app/{{ STAGE }}/TOKEN')
+
+    assert envars.precompile() == 3
+    assert templates.compile_template.cache_info().currsize == 3
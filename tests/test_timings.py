@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from envars import timings
+from envars.kms import KMSAgent
+from tests.test_cli import run_cmd
+
+
+@pytest.fixture
+def recorder():
+    recorder = timings.enable('test')
+    yield recorder
+    timings.disable()
+
+
+def test_phase_noop_when_disabled():
+    with timings.phase('load'):
+        pass
+    assert timings.recorder() is None
+
+
+def test_phases_recorded(recorder):
+    with timings.phase('load'):
+        pass
+    with timings.phase('load'):
+        pass
+    assert recorder.phases['load']['count'] == 2
+
+
+def test_aws_calls_recorded(recorder, kms_stub, monkeypatch):
+    monkeypatch.setattr('envars.kms.time.sleep', lambda s: None)
+    kms_stub.add_client_error('decrypt', service_error_code='ThrottlingException')
+    kms_stub.add_response('decrypt', service_response={'Plaintext': b'sssssh'})
+    assert KMSAgent('abc').decrypt('Y2lwaGVy', {'app': 'testapp'}) == 'sssssh'
+
+    report = recorder.report()
+    decrypt = report['aws']['kms:Decrypt']
+    assert decrypt['calls'] == 2
+    assert decrypt['throttled'] == 1
+    assert decrypt['errors'] == {'ThrottlingException': 1}
+    assert sum(decrypt['histogram'].values()) == 2
+    assert 'Decrypt' in timings.format_text(report)
+
+
+def test_cli_timings_json(tmp_path):
+    run_cmd(tmp_path, 'init --app testapp --environments prod,staging --kms-key-arn abc')
+    run_cmd(tmp_path, "add 'HOST={{ STAGE }}.timeout.com'")
+    ret = run_cmd(tmp_path, f'--timings --timings-format json --timings-file {tmp_path}/timings.json print -e prod -a master')
+    assert ret.returncode == 0
+    with open(f'{tmp_path}/timings.json') as f:
+        report = json.load(f)
+    assert report['command'] == 'print'
+    assert {'load', 'render', 'output'} <= set(report['phases'])
+    assert report['aws'] == {}
@@ -0,0 +1,217 @@
+import signal
+import sys
+import time
+
+import pytest
+from botocore.exceptions import EndpointConnectionError
+
+from envars import envars as cli
+from envars.models import EnVars
+from envars.ssm import ParameterStoreError, SsmAgent
+from envars.watch import ParameterWatcher, Supervisor, parse_on_change
+
+
+def make_envars(tmp_path):
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.app = 'testapp'
+    envars.envs = ['prod']
+    envars.kms_key_arn = 'abc'
+    envars.add('DOMAIN', 'timeout.com')
+    envars.add('OTHER', 'parameter_store:/app/OTHER')
+    envars.add('TOKEN', 'parameter_store:/app/{{ STAGE }}/TOKEN')
+    envars.add('URL', 'https://{{ DOMAIN }}/{{ TOKEN }}')
+    envars.save()
+    return envars
+
+
+def add_parameters(ssm_stub, token, other='other'):
+    ssm_stub.add_response(
+        'get_parameters',
+        service_response={'Parameters': [
+            {'Name': '/app/OTHER', 'Value': other},
+            {'Name': '/app/prod/TOKEN', 'Value': token},
+        ]},
+        expected_params={'Names': ['/app/OTHER', '/app/prod/TOKEN'], 'WithDecryption': True},
+    )
+
+
+def test_parse_on_change():
+    assert parse_on_change('restart') == 'restart'
+    assert parse_on_change('signal:HUP') == signal.SIGHUP
+    assert parse_on_change('signal:SIGUSR1') == signal.SIGUSR1
+    with pytest.raises(Exception, match='Unknown --on-change'):
+        parse_on_change('signal:NOPE')
+
+
+def test_watcher_reports_changes(ssm_stub, tmp_path):
+    watcher = ParameterWatcher(make_envars(tmp_path), 'prod', 'master')
+    add_parameters(ssm_stub, 'one')
+    add_parameters(ssm_stub, 'one')
+    add_parameters(ssm_stub, 'two')
+    assert watcher.poll() is False
+    assert watcher.poll() is False
+    assert watcher.poll() is True
+
+
+def test_watcher_keeps_values_when_poll_fails(ssm_stub, tmp_path, monkeypatch):
+    watcher = ParameterWatcher(make_envars(tmp_path), 'prod', 'master')
+    add_parameters(ssm_stub, 'one')
+    assert watcher.poll() is False
+    values = watcher.values
+
+    ssm_stub.add_client_error('get_parameters', service_error_code='ThrottlingException')
+    assert watcher.poll() is False
+    assert watcher.values == values
+
+    def unreachable(self, names):
+        raise EndpointConnectionError(endpoint_url='https://ssm.eu-west-1.amazonaws.com')
+    with monkeypatch.context() as m:
+        m.setattr(SsmAgent, '_get_parameters', unreachable)
+        assert watcher.poll() is False
+    assert watcher.values == values
+
+    add_parameters(ssm_stub, 'one')
+    assert watcher.poll() is False
+
+
+def test_watcher_first_poll_failure_raises(ssm_stub, tmp_path):
+    watcher = ParameterWatcher(make_envars(tmp_path), 'prod', 'master')
+    ssm_stub.add_client_error('get_parameters', service_error_code='ThrottlingException')
+    with pytest.raises(ParameterStoreError, match='ThrottlingException'):
+        watcher.poll()
+
+
+def test_watcher_only_polls_selected_vars(ssm_stub, tmp_path):
+    watcher = ParameterWatcher(make_envars(tmp_path), 'prod', 'master', names=['URL'])
+    assert watcher.pnames == ['/app/prod/TOKEN']
+    assert ParameterWatcher(make_envars(tmp_path), 'prod', 'master', names=['DOMAIN']).poll() is False
+
+
+def child_script(tmp_path):
+    return [
+        sys.executable,
+        '-c',
+        'import os, signal, sys, time\n'
+        f'out = open("{tmp_path}/out", "a")\n'
+        'signal.signal(signal.SIGHUP, lambda *a: (out.write("HUP\\n"), out.flush()))\n'
+        'out.write(os.environ["TOKEN"] + "\\n")\n'
+        'out.flush()\n'
+        'time.sleep(30)\n',
+    ]
+
+
+def wait_for(path, lines):
+    for _ in range(100):
+        try:
+            with open(path) as f:
+                if len(f.read().splitlines()) >= lines:
+                    break
+        except FileNotFoundError:
+            pass
+        time.sleep(0.05)
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def test_supervisor_restart(tmp_path):
+    supervisor = Supervisor(child_script(tmp_path), {'TOKEN': 'one'})
+    first = supervisor.start()
+    wait_for(f'{tmp_path}/out', 1)
+    supervisor.changed({'TOKEN': 'two'})
+    assert first.poll() is not None
+    assert wait_for(f'{tmp_path}/out', 2) == ['one', 'two']
+    assert supervisor.wait(0.1) is None
+    supervisor.child.kill()
+    supervisor.child.wait()
+
+
+def test_supervisor_kills_child_ignoring_sigterm(tmp_path):
+    script = child_script(tmp_path)
+    script[2] = script[2].replace('time.sleep(30)', 'signal.signal(signal.SIGTERM, signal.SIG_IGN)\ntime.sleep(30)')
+    supervisor = Supervisor(script, {'TOKEN': 'one'}, stop_timeout=0.2)
+    first = supervisor.start()
+    wait_for(f'{tmp_path}/out', 1)
+    started = time.monotonic()
+    supervisor.changed({'TOKEN': 'two'})
+    assert time.monotonic() - started < 5
+    assert first.returncode == -signal.SIGKILL
+    assert wait_for(f'{tmp_path}/out', 2) == ['one', 'two']
+    supervisor.child.kill()
+    supervisor.child.wait()
+
+
+def test_supervisor_signal(tmp_path):
+    supervisor = Supervisor(child_script(tmp_path), {'TOKEN': 'one'}, on_change=signal.SIGHUP)
+    child = supervisor.start()
+    wait_for(f'{tmp_path}/out', 1)
+    supervisor.changed({'TOKEN': 'two'})
+    assert wait_for(f'{tmp_path}/out', 2) == ['one', 'HUP']
+    assert supervisor.child is child
+    child.kill()
+    child.wait()
+
+
+def exec_args(tmp_path):
+    return type('Args', (object,), {
+        'filename': f'{tmp_path}/envars.yml',
+        'env': 'prod',
+        'account': 'master',
+        'template_var': [],
+        'command': ['true'],
+        'refresh_interval': 60,
+        'on_change': 'restart',
+    })
+
+
+def test_exec_refresh_ignores_failed_polls(ssm_stub, tmp_path, monkeypatch):
+    make_envars(tmp_path)
+    add_parameters(ssm_stub, 'one')
+    ssm_stub.add_client_error('get_parameters', service_error_code='ThrottlingException')
+    add_parameters(ssm_stub, 'one')
+
+    events = []
+    monkeypatch.setattr(Supervisor, 'start', lambda self: events.append(('start', self.env['TOKEN'])))
+    monkeypatch.setattr(Supervisor, 'changed', lambda self, env: events.append(('changed', env['TOKEN'])))
+    monkeypatch.setattr(Supervisor, 'stop', lambda self: events.append(('stop',)))
+    waits = iter([None, None])
+
+    def wait(self, timeout):
+        try:
+            return next(waits)
+        except StopIteration:
+            raise (EndpointConnectionError(endpoint_url='https://ssm.eu-west-1.amazonaws.com'))
+    monkeypatch.setattr(Supervisor, 'wait', wait)
+    monkeypatch.setattr(cli.signal, 'signal', lambda signum, handler: None)
+
+    # an error escaping the loop still stops the child
+    with pytest.raises(EndpointConnectionError):
+        cli.execute(exec_args(tmp_path))
+    assert events == [('start', 'one'), ('stop',)]
+
+
+def test_supervisor_stop(tmp_path):
+    supervisor = Supervisor(child_script(tmp_path), {'TOKEN': 'one'})
+    child = supervisor.start()
+    wait_for(f'{tmp_path}/out', 1)
+    supervisor.stop()
+    assert child.returncode == -signal.SIGTERM
+    supervisor.stop()
+
+
+def test_exec_refresh_interval(ssm_stub, tmp_path, monkeypatch):
+    make_envars(tmp_path)
+    # baseline poll, unchanged poll, changed poll, the environment is built from the polled values
+    for token in ['one', 'one', 'two']:
+        add_parameters(ssm_stub, token)
+
+    events = []
+    monkeypatch.setattr(Supervisor, 'start', lambda self: events.append(('start', self.env['TOKEN'], self.env['URL'])))
+    monkeypatch.setattr(Supervisor, 'changed', lambda self, env: events.append(('changed', env['TOKEN'], env['URL'])))
+    waits = iter([None, None, 3])
+    monkeypatch.setattr(Supervisor, 'wait', lambda self, timeout: next(waits))
+    monkeypatch.setattr(cli.signal, 'signal', lambda signum, handler: None)
+
+    with pytest.raises(SystemExit) as e:
+        cli.execute(exec_args(tmp_path))
+    assert e.value.code == 3
+    assert events == [('start', 'one', 'https://timeout.com/one'), ('changed', 'two', 'https://timeout.com/two')]
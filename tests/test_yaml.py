@@ -0,0 +1,148 @@
+import base64
+import os
+
+import yaml
+
+from envars import models
+from envars.models import EnVars, EnvarsDumper, Secret, dump, emits_identically, get_loader
+
+
+def sample_file(tmp_path):
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.app = 'testapp'
+    envars.envs = ['prod', 'staging']
+    envars.kms_key_arn = 'arn:aws:kms:eu-west-1:123456789012:key/abc'
+    for i in range(50):
+        ciphertext = base64.b64encode(os.urandom(150)).decode('utf-8')
+        envars.add(f'SECRET_{i}', Secret('\n'.join(ciphertext[j:j + 80] for j in range(0, len(ciphertext), 80))))
+        envars.add(f'VAR_{i}', ' '.join([f'value {i}'] * (i % 20)), desc=f'variable {i}')
+        envars.add(f'VAR_{i}', f'https://{{{{ STAGE }}}}.timeout.com/{i}', 'prod', account='master')
+        envars.add(f'VAR_{i}', 'parameter_store:/app/{{ STAGE }}/VAR', 'staging')
+    return envars
+
+
+def test_save_matches_pure_python_dumper(tmp_path, monkeypatch):
+    envars = sample_file(tmp_path)
+    assert emits_identically(envars.build_yaml())
+    envars.save()
+    with open(envars.filename, 'rb') as f:
+        fast = f.read()
+
+    monkeypatch.setattr(models, 'FastDumper', None)
+    envars.source = None
+    envars.save()
+    with open(envars.filename, 'rb') as f:
+        assert f.read() == fast
+
+
+def test_round_trip_with_loader(tmp_path):
+    envars = sample_file(tmp_path)
+    envars.save()
+    loaded = EnVars(envars.filename)
+    loaded.load()
+
+    assert loaded.build_yaml()['SECRET_3']['default'].value == envars.build_yaml()['SECRET_3']['default'].value
+    assert loaded.build_yaml()['VAR_3'] == envars.build_yaml()['VAR_3']
+
+
+def test_unusual_strings_use_pure_python_dumper():
+    data = {'environment_variables': {'TEST': {'default': 'café ' * 30 + 'trailing space '}}}
+    assert not emits_identically(data)
+    assert dump(data) == yaml.dump(data, Dumper=EnvarsDumper, default_flow_style=False)
+
+
+def test_secret_tag_not_registered_globally():
+    assert '!secret' not in yaml.SafeLoader.yaml_constructors
+    assert '!secret' in get_loader().yaml_constructors
+
+
+def full_save(envars):
+    envars.source = None
+    envars.save()
+    with open(envars.filename) as f:
+        return f.read()
+
+
+def test_incremental_save_matches_full_save(tmp_path):
+    sample_file(tmp_path).save()
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.load()
+    envars.add('VAR_7', 'changed', 'staging')
+    envars.add('AAA_FIRST', 'first')
+    envars.add('VAR_25A', 'middle', desc='inserted')
+    envars.add('ZZZ_LAST', 'last')
+    envars.remove('VAR_9')
+    envars.remove('SECRET_0')
+    envars.remove('VAR_49')
+    envars.envs.append('dev')
+    envars.save()
+    with open(envars.filename) as f:
+        patched = f.read()
+
+    assert patched == full_save(envars)
+    assert yaml.load(patched, Loader=get_loader())['environment_variables']['VAR_7']['staging'] == 'changed'
+
+
+def test_incremental_save_keeps_comments(tmp_path):
+    sample_file(tmp_path).save()
+    with open(f'{tmp_path}/envars.yml') as f:
+        text = f.read()
+    text = text.replace('\n  VAR_1:\n', '\n  # VAR_1 is left alone\n  VAR_1:\n', 1)
+    text = text.replace('\n  VAR_2:\n', '\n  # comment above VAR_2\n  VAR_2:\n', 1)
+    with open(f'{tmp_path}/envars.yml', 'w') as f:
+        f.write(text)
+
+    envars = EnVars(f'{tmp_path}/envars.yml')
+    envars.load()
+    envars.add('VAR_2', 'changed')
+    envars.save()
+    with open(envars.filename) as f:
+        patched = f.read()
+    assert '# VAR_1 is left alone' in patched
+    assert '# comment above VAR_2' in patched
+    assert patched.split('  VAR_2:\n')[0] == text.split('  VAR_2:\n')[0]
+    assert patched.split('  VAR_20:\n')[1] == text.split('  VAR_20:\n')[1]
+
+    loaded = EnVars(envars.filename)
+    loaded.load()
+    assert loaded.index.get('VAR_2').envs['default'] == 'changed'
+    assert loaded.build_yaml()['VAR_1'] == envars.build_yaml()['VAR_1']
+
+
+def test_incremental_save_keeps_data_keys_comments(tmp_path):
+    envars = sample_file(tmp_path)
+    envars.data_keys = {'default': Secret('ZGF0YWtleQ=='), 'prod': Secret('cHJvZGtleQ==')}
+    envars.save()
+    with open(envars.filename) as f:
+        text = f.read()
+    text = text.replace('\n  APP: testapp\n', '\n  # owned by the platform team\n  APP: testapp\n', 1)
+    with open(envars.filename, 'w') as f:
+        f.write(text)
+
+    envars = EnVars(envars.filename)
+    envars.load()
+    envars.add('VAR_2', 'changed')
+    envars.save()
+    with open(envars.filename) as f:
+        patched = f.read()
+    assert patched.split('environment_variables:')[0] == text.split('environment_variables:')[0]
+
+
+def test_unchanged_save_keeps_file(tmp_path):
+    path = f'{tmp_path}/envars.yml'
+    with open(path, 'w') as f:
+        f.write(
+            'configuration:\n  APP: testapp\n  ENVIRONMENTS: [prod]\n  KMS_KEY_ARN: abc\n'
+            'environment_variables:\n  HOST: {default: www.timeout.com}\n'
+        )
+    envars = EnVars(path)
+    envars.load()
+    envars.save()
+    with open(path) as f:
+        assert 'ENVIRONMENTS: [prod]' in f.read()
+
+    # not laid out the way save writes it, so changes rewrite it in full
+    envars.add('HOST', 'timeout.com')
+    envars.save()
+    with open(path) as f:
+        assert f.read() == full_save(envars)